@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""Benchmarks the throughput and accuracy of the post parsers.
+
+Runs each parsing method over the matching entries of the corpus (see
+make_corpus.py) and reports titles per second, p50/p99 per-title latency and
+parse accuracy. Results can be saved as a baseline, and later runs compared
+against it to catch slowdowns and match regressions before deploying.
+
+usage: ./bench_parser.py [--corpus corpus.jsonl] [--repeat N]
+                         [--save baseline.json] [--compare baseline.json]
+
+author: Soobeen Park
+file: bench_parser.py
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+
+import titleparser  # noqa: E402
+from titleparser import TitleParser  # noqa: E402
+
+
+def is_correct(parsed, expected) -> bool:
+    """Checks a parse against the expected result of a corpus entry."""
+    if expected is None:
+        # Post should have been rejected
+        return not parsed
+    if not parsed:
+        return False
+    return all(parsed.get(key) == value for key, value in expected.items())
+
+
+def percentile(sorted_values, p) -> float:
+    """The p-th percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))))
+    return sorted_values[i]
+
+
+def bench_method(parse, entries, repeat) -> dict:
+    """Benchmarks a single-post parsing method.
+
+    Args:
+        parse (function): Takes a corpus entry, returns the parsed dict.
+        entries (list): The corpus entries to parse.
+        repeat (int): Number of times to parse the whole list.
+
+    Return:
+        dict: The benchmark results.
+    """
+    latencies = []
+    correct = 0
+    for i in range(repeat):
+        for entry in entries:
+            start = time.perf_counter()
+            parsed = parse(entry)
+            latencies.append(time.perf_counter() - start)
+            if i == 0:
+                correct += is_correct(parsed, entry["expected"])
+
+    latencies.sort()
+    total = sum(latencies)
+    return {"entries": len(entries),
+            "titles_per_sec": len(latencies) / total if total else 0.0,
+            "p50_us": percentile(latencies, 50) * 1e6,
+            "p99_us": percentile(latencies, 99) * 1e6,
+            "accuracy": correct / len(entries) if entries else 0.0}
+
+
+def bench_parse_many(entries, repeat) -> dict:
+    """Benchmarks TitleParser.parse_many, as used by FreshTracks.parse_fresh.
+
+    parse_many parses a whole batch at once, so per-title latency is the
+    batch time divided evenly over its titles.
+    """
+    by_subreddit = dict()
+    for entry in entries:
+        by_subreddit.setdefault(entry["subreddit"], []).append(entry)
+
+    batch_times = []
+    correct = 0
+    for i in range(repeat):
+        for subreddit_name, batch in by_subreddit.items():
+            parser = TitleParser(subreddit_name)
+            batch_entries = [(e["title"], e["flair"], e["description"])
+                             for e in batch]
+            start = time.perf_counter()
+            parsed_dicts = parser.parse_many(batch_entries)
+            elapsed = time.perf_counter() - start
+            batch_times.extend([elapsed / len(batch)] * len(batch))
+            if i == 0:
+                correct += sum(is_correct(parsed, e["expected"])
+                               for parsed, e in zip(parsed_dicts, batch))
+
+    batch_times.sort()
+    total = sum(batch_times)
+    return {"entries": len(entries),
+            "titles_per_sec": len(batch_times) / total if total else 0.0,
+            "p50_us": percentile(batch_times, 50) * 1e6,
+            "p99_us": percentile(batch_times, 99) * 1e6,
+            "accuracy": correct / len(entries) if entries else 0.0}
+
+
+def run_benchmarks(corpus, repeat) -> dict:
+    """Runs the benchmark of every parsing method over the corpus."""
+    by_kind = dict()
+    for entry in corpus:
+        by_kind.setdefault(entry["kind"], []).append(entry)
+
+    # Keyed by the FreshTracks method each parser backs
+    return {
+        "parse_post_title_with_FRESH": bench_method(
+            lambda e: titleparser.parse_title_with_fresh(e["title"]),
+            by_kind.get("fresh_title", []), repeat),
+        "parse_post_title_wo_FRESH": bench_method(
+            lambda e: titleparser.parse_title_wo_fresh(e["flair"],
+                                                       e["title"]),
+            by_kind.get("flair_title", []), repeat),
+        "parse_post_embdedded_media": bench_method(
+            lambda e: titleparser.parse_embedded_media(e["description"]),
+            by_kind.get("embedded_media", []), repeat),
+        "parse_fresh": bench_parse_many(corpus, repeat),
+    }
+
+
+def compare(results, baseline, max_slowdown, max_accuracy_drop) -> list:
+    """Compares results with a baseline.
+
+    Return:
+        list: A description of each regression found.
+    """
+    regressions = []
+    for method, result in results.items():
+        base = baseline.get(method)
+        if not base:
+            continue
+        if result["titles_per_sec"] < \
+                base["titles_per_sec"] * (1 - max_slowdown):
+            regressions.append("%s: %.0f titles/s, baseline %.0f titles/s"
+                               % (method, result["titles_per_sec"],
+                                  base["titles_per_sec"]))
+        if result["accuracy"] < base["accuracy"] - max_accuracy_drop:
+            regressions.append("%s: accuracy %.2f%%, baseline %.2f%%"
+                               % (method, result["accuracy"] * 100,
+                                  base["accuracy"] * 100))
+    return regressions
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--corpus", default=os.path.join(here, "corpus.jsonl"))
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="times to parse the corpus (default: 5)")
+    parser.add_argument("--save", metavar="BASELINE",
+                        help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="exit 1 if slower or less accurate than baseline")
+    parser.add_argument("--max-slowdown", type=float, default=0.2,
+                        help="allowed throughput drop, as a fraction "
+                             "(default: 0.2)")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.0,
+                        help="allowed accuracy drop, as a fraction "
+                             "(default: 0)")
+    args = parser.parse_args()
+
+    with open(args.corpus) as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+
+    results = run_benchmarks(corpus, args.repeat)
+
+    print("%-28s %7s %12s %9s %9s %9s" % ("method", "entries", "titles/s",
+                                          "p50 us", "p99 us", "accuracy"))
+    for method, r in results.items():
+        print("%-28s %7d %12.0f %9.1f %9.1f %8.2f%%" % (
+            method, r["entries"], r["titles_per_sec"], r["p50_us"],
+            r["p99_us"], r["accuracy"] * 100))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_slowdown,
+                              args.max_accuracy_drop)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
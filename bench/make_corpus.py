@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""Generates the parser benchmark corpus.
+
+Each corpus entry is a post as FreshTracks sees it (title, flair text and
+embedded Spotify media description), along with the artist, title and
+freshtype that a correct parse should return. The expected values come from
+the templates the posts are built from, not from the parser, so that parse
+accuracy can be measured.
+
+The post styles mirror those seen on r/indieheads, r/hiphopheads and
+r/popheads, including the ones the parser is known to get wrong (ie. en dashes
+and hyphens in titles), so that accuracy improvements show up too.
+
+usage: ./make_corpus.py [-n NUM_ENTRIES] [-o corpus.jsonl]
+
+author: Soobeen Park
+file: make_corpus.py
+"""
+
+import argparse
+import json
+import random
+
+ARTISTS = [
+    "Phoebe Bridgers", "Big Thief", "Japanese Breakfast", "Fleet Foxes",
+    "Tame Impala", "Mitski", "Alvvays", "Car Seat Headrest", "Soccer Mommy",
+    "Snail Mail", "Beach House", "Arcade Fire", "Vampire Weekend", "Wilco",
+    "Bon Iver", "Sufjan Stevens", "The National", "Waxahatchee", "Angel Olsen",
+    "Kurt Vile", "Animal Collective", "Grizzly Bear", "Deerhunter",
+    "King Gizzard & The Lizard Wizard", "black midi", "Black Country, New Road",
+    "Squid", "Dry Cleaning", "IDLES", "Fontaines D.C.", "Wet Leg",
+    "Caroline Polachek", "Weyes Blood", "Sharon Van Etten", "Julien Baker",
+    "boygenius", "Lucy Dacus", "Porches", "Alex G", "Men I Trust",
+    "Kendrick Lamar", "J. Cole", "Tyler, The Creator", "Freddie Gibbs",
+    "Run The Jewels", "Denzel Curry", "JPEGMAFIA", "Danny Brown", "Earl Sweatshirt",
+    "Vince Staples", "Little Simz", "Mac Miller", "Travis Scott", "Pusha T",
+    "Kanye West", "Jay-Z", "A$AP Rocky", "Isaiah Rashad", "Saba", "Noname",
+    "Smino", "Joey Bada$$", "Westside Gunn", "Conway the Machine",
+    "Benny the Butcher", "Mach-Hommy", "billy woods", "Armand Hammer",
+    "MIKE", "Lil Uzi Vert", "21 Savage", "Megan Thee Stallion", "Doja Cat",
+    "Taylor Swift", "Ariana Grande", "Dua Lipa", "Lady Gaga", "Carly Rae Jepsen",
+    "Charli XCX", "Lorde", "Olivia Rodrigo", "Billie Eilish", "Harry Styles",
+    "Beyoncé", "Rosalía", "Kylie Minogue", "Robyn", "Troye Sivan", "Rina Sawayama",
+    "Kim Petras", "Selena Gomez", "Halsey", "Sabrina Carpenter", "Tove Lo",
+    "MØ", "Sigrid", "Years & Years", "Christine and the Queens", "BTS",
+    "BLACKPINK", "TWICE", "Red Velvet", "Jessie Ware", "Kacey Musgraves",
+    "Hayley Williams", "Bleachers", "The 1975", "Haim", "Paramore",
+]
+
+TITLE_WORDS = [
+    "Summer", "Night", "Motion", "Gold", "Heaven", "Ghost", "Blue", "Water",
+    "Fire", "Dream", "Shadow", "Light", "Window", "Drive", "Honey", "Static",
+    "Garden", "Silver", "Mirror", "Paper", "Stone", "Velvet", "Neon", "River",
+    "Echo", "Wild", "Slow", "Falling", "Burning", "Electric", "Holy", "Lonely",
+    "Strange", "Sweet", "Cold", "Broken", "Golden", "Hollow", "Tender",
+    "Forever", "Tonight", "Again", "Home", "Away", "Alive", "Kids", "Love",
+    "Money", "Angel", "Crown", "Ocean", "Song", "Letter", "Machine", "Season",
+]
+
+FEATURES = ["feat. Frank Ocean", "ft. Kendrick Lamar", "feat. Phoebe Bridgers",
+            "with Charli XCX", "prod. by Madlib", "Remix"]
+
+FRESH_TAGS = [("FRESH", 6), ("FRESH ALBUM", 3), ("FRESH EP", 2),
+              ("FRESH SINGLE", 1), ("FRESH STREAM", 1), ("Fresh", 2),
+              ("fresh album", 1)]
+INVALID_TAGS = [("FRESH VIDEO", 3), ("FRESH PERFORMANCE", 2)]
+POPHEADS_FLAIRS = [("FRESH", 6), ("FRESH ALBUM", 2), ("FRESH EP", 1),
+                   ("FRESH VIDEO", 2), ("DISCUSSION", 2), ("NEWS", 1)]
+MEDIA_TYPES = [("Song", 5), ("Album", 3), ("EP", 1), ("Single", 2)]
+
+
+def weighted(rng, choices):
+    """Picks from (value, weight) pairs."""
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+
+def make_title(rng) -> str:
+    """Makes up a song/album title, sometimes containing a hyphen."""
+    words = rng.sample(TITLE_WORDS, rng.choice([1, 1, 2, 2, 3]))
+    title = " ".join(words)
+    if rng.random() < 0.05:
+        title = title.replace(" ", "-", 1) if " " in title \
+            else title + "-" + rng.choice(TITLE_WORDS)
+    return title
+
+
+def decorate(rng, title) -> str:
+    """Sometimes adds a parenthesized feature, which a parse should drop."""
+    if rng.random() < 0.2:
+        return title + " (" + rng.choice(FEATURES) + ")"
+    return title
+
+
+def dash(rng) -> str:
+    """The artist/title separator, in the spellings people actually use."""
+    return weighted(rng, [(" - ", 90), ("-", 3), (" -", 2), (" – ", 4),
+                          (" — ", 1)])
+
+
+def fresh_title_entry(rng) -> dict:
+    """An r/indieheads or r/hiphopheads style [FRESH ...] title."""
+    artist = rng.choice(ARTISTS)
+    title = make_title(rng)
+    valid = rng.random() < 0.85
+    tag = weighted(rng, FRESH_TAGS if valid else INVALID_TAGS)
+    spacing = weighted(rng, [("[%s] ", 20), ("[%s]", 2), ("[ %s ] ", 1)])
+
+    post_title = (spacing % tag) + artist + dash(rng) + decorate(rng, title)
+    if rng.random() < 0.1:
+        post_title += rng.choice([" | Official Audio", " [2021]"])
+
+    return {"kind": "fresh_title",
+            "subreddit": rng.choice(["indieheads", "hiphopheads"]),
+            "title": post_title,
+            "flair": None,
+            "description": None,
+            "expected": {"artist": artist, "title": title, "freshtype": tag}
+            if valid else None}
+
+
+def flair_title_entry(rng) -> dict:
+    """An r/popheads style title with the [FRESH ...] tag in the flair."""
+    artist = rng.choice(ARTISTS)
+    title = make_title(rng)
+    flair = weighted(rng, POPHEADS_FLAIRS)
+    valid = flair.startswith("FRESH") and flair != "FRESH VIDEO"
+
+    return {"kind": "flair_title",
+            "subreddit": "popheads",
+            "title": artist + dash(rng) + decorate(rng, title),
+            "flair": flair,
+            "description": None,
+            "expected": {"artist": artist, "title": title, "freshtype": flair}
+            if valid else None}
+
+
+def embedded_media_entry(rng) -> dict:
+    """A post with an embedded Spotify oEmbed description."""
+    artist = rng.choice(ARTISTS)
+    title = make_title(rng)
+    media_type = weighted(rng, MEDIA_TYPES)
+    year = rng.randint(2015, 2022)
+
+    desc = "Listen to %s on Spotify. %s · %s · %d" % (title, artist,
+                                                      media_type, year)
+    if media_type in ("Album", "EP"):
+        desc += " · %d songs" % rng.randint(4, 24)
+    desc += "."
+
+    return {"kind": "embedded_media",
+            "subreddit": rng.choice(["indieheads", "hiphopheads", "popheads"]),
+            "title": "[FRESH] " + artist + " - " + title,
+            "flair": "FRESH",
+            "description": desc,
+            "expected": {"artist": artist, "title": title}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-n", "--num-entries", type=int, default=4000)
+    parser.add_argument("-o", "--output", default="corpus.jsonl")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    makers = [(fresh_title_entry, 5), (flair_title_entry, 3),
+              (embedded_media_entry, 2)]
+
+    with open(args.output, "w") as f:
+        for _ in range(args.num_entries):
+            entry = weighted(rng, makers)(rng)
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
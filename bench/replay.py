@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+"""Records and replays full FreshTracks runs, to benchmark them offline.
+
+In record mode, every subreddit is run as usual against live Reddit and
+Spotify, and every HTTP exchange PRAW and spotipy make is saved to a cassette
+directory, along with a snapshot of the Mongo database from before the run and
+the time the run started.
+
+In replay mode, the database snapshot is restored into a separate replay
+database, and the run is repeated as of the recorded time, with every HTTP
+exchange served from the cassette by an in-process stand-in session instead of
+the network, after an injected latency. The replay is deterministic, so runs
+can be profiled and compared on a laptop without network access or API
+credentials (a local MongoDB server is still needed).
+
+Both modes report the wall time of each stage and the number of API calls
+each stage made.
+
+usage: ./replay.py record CASSETTE_DIR [--subreddit NAME ...]
+       ./replay.py replay CASSETTE_DIR [--latency-ms MS | --recorded-latency]
+                                       [--jitter-ms MS] [--concurrent]
+
+author: Soobeen Park
+file: replay.py
+"""
+
+import argparse
+import base64
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timezone
+import json
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from bson import json_util
+import pymodm
+from pymodm import connect
+import requests
+from requests.structures import CaseInsensitiveDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+
+from freshtracks import FreshTracks  # noqa: E402
+from main import (COMBINED_LISTING, SUBREDDIT_SETTINGS,  # noqa: E402
+                  retrieve_combined, run_subreddit)
+from pipeline import Feed  # noqa: E402
+from redditcli import RedditCli  # noqa: E402
+from searchcache import SearchCache  # noqa: E402
+from spotifycli import SpotifyCli  # noqa: E402
+from stages import current_stage  # noqa: E402
+
+HTTP_FILE = "http.jsonl"
+DB_FILE = "db.json"
+META_FILE = "meta.json"
+
+# Endpoints that hand out access tokens. Their requests hold credentials and
+# their responses hold tokens, so neither is saved. They are matched on URL
+# alone, since the credentials differ between record and replay.
+AUTH_URLS = ("https://www.reddit.com/api/v1/access_token",
+             "https://accounts.spotify.com/api/token")
+
+
+def request_key(method, url, params=None, data=None, json_body=None) -> str:
+    """Builds the key a request is matched on between record and replay.
+
+    Query parameters are merged into the URL and sorted, and the body is
+    normalized, so that equal requests get equal keys.
+    """
+    scheme, netloc, path, query, _ = urlsplit(url)
+    if scheme + "://" + netloc + path in AUTH_URLS:
+        return method.upper() + " " + scheme + "://" + netloc + path
+
+    query_items = parse_qsl(query, keep_blank_values=True)
+    if params:
+        items = params.items() if isinstance(params, dict) else params
+        query_items.extend((k, str(v)) for k, v in items if v is not None)
+    url = urlunsplit((scheme, netloc, path, urlencode(sorted(query_items)),
+                      ""))
+
+    if json_body is not None:
+        body = json.dumps(json_body, sort_keys=True)
+    elif isinstance(data, (dict, list, tuple)):
+        items = data.items() if isinstance(data, dict) else data
+        body = urlencode(sorted(items))
+    elif isinstance(data, bytes):
+        body = data.decode("utf-8", "replace")
+    else:
+        body = data or ""
+
+    return method.upper() + " " + url + " " + body
+
+
+def stage_label() -> str:
+    """Label of the stage the current thread is running, for counting."""
+    stage_key = current_stage.get()
+    return "/".join(stage_key) if stage_key else "setup"
+
+
+class RecordingSession(requests.Session):
+    """A requests session that saves every exchange it makes."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.file = open(path, "w")
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+    def request(self, method, url, params=None, data=None, json=None,
+                **kwargs):
+        start = time.perf_counter()
+        response = super().request(method, url, params=params, data=data,
+                                   json=json, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        key = request_key(method, url, params, data, json)
+        content = response.content
+        if key.split(" ")[1] in AUTH_URLS:
+            content = b'{"access_token": "replay", "token_type": "bearer", ' \
+                      b'"expires_in": 3600, "scope": "*"}'
+
+        record = {"key": key,
+                  "stage": stage_label(),
+                  "status": response.status_code,
+                  "reason": response.reason,
+                  "headers": dict(response.headers),
+                  "url": response.url,
+                  "content": base64.b64encode(content).decode("ascii"),
+                  "elapsed": elapsed}
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.calls[record["stage"]] += 1
+        return response
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+class ReplaySession(requests.Session):
+    """A stand-in requests session that serves recorded exchanges.
+
+    Each request is answered with the next unserved response recorded for an
+    equal request, after the injected latency.
+    """
+
+    def __init__(self, path, latency=0.0, jitter=0.0, recorded_latency=False,
+                 seed=0):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.recorded_latency = recorded_latency
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.unmatched = Counter()
+
+        self.responses = defaultdict(deque)
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                self.responses[record["key"]].append(record)
+
+    def request(self, method, url, params=None, data=None, json=None,
+                **kwargs):
+        key = request_key(method, url, params, data, json)
+        with self.lock:
+            self.calls[stage_label()] += 1
+            queue = self.responses.get(key)
+            if not queue:
+                self.unmatched[key] += 1
+                record = None
+            elif len(queue) == 1 or key.split(" ")[1] in AUTH_URLS:
+                # Keep serving the last response to repeated requests
+                record = queue[0]
+            else:
+                record = queue.popleft()
+            delay = record["elapsed"] if record and self.recorded_latency \
+                else self.latency + self.rng.uniform(0, self.jitter)
+
+        time.sleep(delay)
+
+        response = requests.Response()
+        response.url = url
+        response.encoding = "utf-8"
+        if record is None:
+            response.status_code = 404
+            response.reason = "Not Recorded"
+            response._content = b'{"error": {"message": "not recorded"}}'
+            response.headers = CaseInsensitiveDict()
+            return response
+
+        response.status_code = record["status"]
+        response.reason = record["reason"]
+        response.headers = CaseInsensitiveDict(record["headers"])
+        # The recorded content is already decoded
+        response.headers.pop("Content-Encoding", None)
+        response._content = base64.b64decode(record["content"])
+        return response
+
+
+def all_models():
+    """All MongoModel classes used by FreshTracks."""
+    models = []
+    pending = list(pymodm.MongoModel.__subclasses__())
+    while pending:
+        model = pending.pop()
+        models.append(model)
+        pending.extend(model.__subclasses__())
+    return models
+
+
+def snapshot_db(db, path):
+    """Saves every collection of db to a JSON file."""
+    snapshot = {name: list(db[name].find())
+                for name in db.list_collection_names()}
+    with open(path, "w") as f:
+        f.write(json_util.dumps(snapshot))
+
+
+def restore_db(db, path):
+    """Replaces the contents of db with a snapshot saved by snapshot_db().
+
+    The models' indexes are created, except for TTL indexes, since those
+    would have MongoDB expire documents by the real time instead of the
+    recorded one.
+    """
+    with open(path) as f:
+        snapshot = json_util.loads(f.read())
+
+    for name in db.list_collection_names():
+        db.drop_collection(name)
+    for name, documents in snapshot.items():
+        if documents:
+            db[name].insert_many(documents)
+
+    for model in all_models():
+        meta = model._mongometa
+        indexes = [index for index in meta.indexes
+                   if "expireAfterSeconds" not in index.document]
+        if indexes:
+            db[meta.collection_name].create_indexes(indexes)
+        # Keep pymodm from creating the indexes itself
+        meta._indexes_created = True
+
+
+def run_subreddits(subreddit_settings, rcli, scli, now, concurrent) -> list:
+    """Runs FreshTracks for every subreddit, as main.py does.
+
+    Each subreddit is run with main.run_subreddit(), and if
+    main.COMBINED_LISTING is set, its new posts are fed from
+    main.retrieve_combined(). When the subreddits aren't run concurrently,
+    the combined listing is walked in full before the first one starts, so
+    their feeds are unbounded.
+
+    Return:
+        list: (subreddit name, stage times, error) of each subreddit.
+    """
+    freshtracks_by_name = dict()
+    errors = dict()
+    for subreddit_setting in subreddit_settings:
+        subreddit_name = subreddit_setting["subreddit_name"]
+        try:
+            freshtracks_by_name[subreddit_name] = FreshTracks(
+                subreddit_setting, rcli, scli, now=now)
+        except Exception as e:
+            errors[subreddit_name] = e
+
+    feeds = dict()
+    if COMBINED_LISTING:
+        feeds = {subreddit_name:
+                 Feed(freshtracks.stream_buffer_size if concurrent else 0)
+                 for subreddit_name, freshtracks
+                 in freshtracks_by_name.items()}
+
+    def combine():
+        if not feeds:
+            return
+        try:
+            retrieve_combined(freshtracks_by_name, rcli, feeds)
+        except Exception as e:
+            print("Combined listing failed: " + str(e))
+
+    def run(subreddit_name):
+        try:
+            run_subreddit(freshtracks_by_name[subreddit_name],
+                          feeds.get(subreddit_name))
+        except Exception as e:
+            errors[subreddit_name] = e
+
+    if concurrent:
+        threads = [threading.Thread(target=run, args=(subreddit_name,))
+                   for subreddit_name in freshtracks_by_name]
+        for thread in threads:
+            thread.start()
+        combine()
+        for thread in threads:
+            thread.join()
+    else:
+        combine()
+        for subreddit_name in freshtracks_by_name:
+            run(subreddit_name)
+
+    results = []
+    for subreddit_setting in subreddit_settings:
+        subreddit_name = subreddit_setting["subreddit_name"]
+        freshtracks = freshtracks_by_name.get(subreddit_name)
+        stage_times = freshtracks.stage_times if freshtracks else dict()
+        results.append((subreddit_name, stage_times,
+                        errors.get(subreddit_name)))
+    return results
+
+
+def report(results, calls, wall_time):
+    """Prints the wall time and API calls of each stage."""
+    print("\n%-12s %-16s %10s %9s" % ("subreddit", "stage", "wall (s)",
+                                      "API calls"))
+    for subreddit_name, stage_times, error in results:
+        for stage_name, seconds in stage_times.items():
+            print("%-12s %-16s %10.3f %9d" % (
+                subreddit_name, stage_name, seconds,
+                calls[subreddit_name + "/" + stage_name]))
+        if error:
+            print("%-12s FAILED: %r" % (subreddit_name, error))
+    print("%-12s %-16s %10s %9d" % ("", "setup", "", calls["setup"]))
+    print("\nTotal: %.3fs wall time, %d API calls"
+          % (wall_time, sum(calls.values())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("cassette", help="directory of the recorded run")
+    parser.add_argument("--subreddit", action="append",
+                        help="only run this subreddit (repeatable)")
+    parser.add_argument("--mongo-uri",
+                        help="database to snapshot when recording, or to "
+                             "restore into when replaying (default: "
+                             "FreshTracks / FreshTracksReplay on localhost)")
+    parser.add_argument("--latency-ms", type=float, default=50.0,
+                        help="latency injected into each replayed request "
+                             "(default: 50)")
+    parser.add_argument("--jitter-ms", type=float, default=0.0,
+                        help="random extra latency, up to this much")
+    parser.add_argument("--recorded-latency", action="store_true",
+                        help="replay each request with its recorded latency")
+    parser.add_argument("--concurrent", action="store_true",
+                        help="run the subreddits in parallel, as main.py does")
+    args = parser.parse_args()
+
+    subreddit_settings = [s for s in SUBREDDIT_SETTINGS
+                          if not args.subreddit or
+                          s["subreddit_name"] in args.subreddit]
+    http_path = os.path.join(args.cassette, HTTP_FILE)
+    db_path = os.path.join(args.cassette, DB_FILE)
+    meta_path = os.path.join(args.cassette, META_FILE)
+
+    if args.mode == "record":
+        if not os.path.exists(args.cassette):
+            os.makedirs(args.cassette)
+        mongo_uri = args.mongo_uri or "mongodb://localhost:27017/FreshTracks"
+        connect(mongo_uri, alias="FreshTracks")
+        snapshot_db(pymodm.connection._get_db("FreshTracks"), db_path)
+
+        now = datetime.now(timezone.utc)
+        with open(meta_path, "w") as f:
+            json.dump({"now": now.isoformat(),
+                       "subreddits": [s["subreddit_name"]
+                                      for s in subreddit_settings]}, f)
+
+        session = RecordingSession(http_path)
+        rcli = RedditCli("bot1", "basic", session=session)
+        scli = SpotifyCli(requests_session=session)
+
+    else:
+        mongo_uri = args.mongo_uri or \
+            "mongodb://localhost:27017/FreshTracksReplay"
+        connect(mongo_uri, alias="FreshTracks")
+        restore_db(pymodm.connection._get_db("FreshTracks"), db_path)
+
+        with open(meta_path) as f:
+            now = datetime.fromisoformat(json.load(f)["now"])
+
+        session = ReplaySession(http_path,
+                                latency=args.latency_ms / 1000,
+                                jitter=args.jitter_ms / 1000,
+                                recorded_latency=args.recorded_latency)
+        rcli = RedditCli(None, "basic", session=session,
+                         client_id="replay", client_secret="replay",
+                         user_agent="FreshTracks replay harness",
+                         check_for_updates=False)
+        naive_now = now.astimezone(timezone.utc).replace(tzinfo=None)
+        scli = SpotifyCli(requests_session=session, auth="replay",
+                          search_cache=SearchCache(clock=lambda: naive_now))
+
+    start = time.perf_counter()
+    results = run_subreddits(subreddit_settings, rcli, scli, now,
+                             args.concurrent)
+    wall_time = time.perf_counter() - start
+
+    report(results, session.calls, wall_time)
+    if args.mode == "replay" and session.unmatched:
+        print("\n%d requests weren't in the recording, ie.:"
+              % sum(session.unmatched.values()))
+        for key, count in session.unmatched.most_common(5):
+            print("\t%dx %s" % (count, key[:200]))
+
+    session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""Checks that the hot queries of FreshTracks are served by indexes.
+
+Creates the models' indexes, then explains each query that FreshTracks runs
+over and over for a subreddit, and exits 1 if any of them scans the whole
+collection (COLLSCAN) or sorts its results in memory (SORT). Run it after
+changing a query or an index, so the queries stay fast as the post history
+grows.
+
+usage: ./checkindexes.py
+
+author: Soobeen Park
+file: checkindexes.py
+"""
+
+from datetime import datetime, timedelta
+import sys
+
+import pymongo
+
+from models.post import Post
+from models.playlisttrack import PlaylistTrack
+from models.albumpopularity import AlbumPopularity
+from models.searchresult import SearchResult
+from models.checkpoint import Checkpoint
+from models.playlistsnapshot import PlaylistSnapshot
+
+MODELS = [Post, PlaylistTrack, AlbumPopularity, SearchResult, Checkpoint,
+          PlaylistSnapshot]
+
+# Plan stages that mean a query isn't (fully) served by an index
+BAD_STAGES = {"COLLSCAN", "SORT"}
+
+
+def ensure_indexes():
+    """Creates the indexes of every model, if they don't exist yet.
+
+    pymodm only creates a model's indexes on its first query, so this is
+    called on startup to have them in place before any query runs.
+    """
+    for model in MODELS:
+        meta = model._mongometa
+        # Keep pymodm from creating them again on first access
+        meta._indexes_created = True
+        if meta.indexes:
+            meta.collection.create_indexes(meta.indexes)
+
+
+def hot_queries(subreddit_setting, now) -> dict:
+    """The queries run over and over for a subreddit, as pymongo cursors.
+
+    Each mirrors a query made by FreshTracks, and must be kept in sync with
+    it.
+
+    Args:
+        subreddit_setting (dict): Info needed for the subreddit.
+        now (datetime.datetime): The (naive UTC) time of the pass.
+
+    Return:
+        dict: The cursor of each query, keyed by a description.
+    """
+    subreddit_name = subreddit_setting["subreddit_name"]
+    one_week_ago = now - timedelta(weeks=1)
+    posts = Post._mongometa.collection
+    search_results = SearchResult._mongometa.collection
+
+    return {
+        "get_last_accessed_time":
+            posts.find({"subreddit": subreddit_name})
+            .sort([("created_utc", pymongo.DESCENDING)])
+            .limit(1),
+        "refresh_upvotes":
+            posts.find({"$and": [{"created_utc": {"$gte": one_week_ago}},
+                                 {"subreddit": subreddit_name}]}),
+        # The $match that starts the get_playlisttracks_ordered() pipeline.
+        # The $lookup that follows it reads PlaylistTracks by _id.
+        "get_playlisttracks_ordered":
+            posts.find({"subreddit": subreddit_name,
+                        "exists_in_playlist": True}),
+        "update_playlist_ordered":
+            posts.find({"$and": [
+                {"created_utc": {"$gte": one_week_ago}},
+                {"upvotes": {"$gte": subreddit_setting["upvote_thresh"]}},
+                {"subreddit": subreddit_name}]})
+            .sort([("upvotes", pymongo.DESCENDING)]),
+        "SearchCache eviction":
+            search_results.find({})
+            .sort([("created", pymongo.ASCENDING)])
+            .limit(1),
+    }
+
+
+def plan_stages(plan) -> set:
+    """Collects the names of all stages in an explained query plan."""
+    stages = set()
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.add(plan["stage"])
+        for value in plan.values():
+            stages |= plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages |= plan_stages(value)
+    return stages
+
+
+def check_query(cursor) -> set:
+    """Explains a query.
+
+    Args:
+        cursor (pymongo.cursor.Cursor): The query to explain.
+
+    Return:
+        set: The bad stages in the query's winning plan.
+    """
+    explained = cursor.explain()
+    return plan_stages(explained["queryPlanner"]["winningPlan"]) & BAD_STAGES
+
+
+def main():
+    # main.py imports ensure_indexes() from here
+    from main import SUBREDDIT_SETTINGS
+
+    ensure_indexes()
+    now = datetime.utcnow()
+
+    failed = False
+    for subreddit_setting in SUBREDDIT_SETTINGS:
+        print("Checking queries of r/" + subreddit_setting["subreddit_name"])
+        for name, cursor in hot_queries(subreddit_setting, now).items():
+            bad_stages = check_query(cursor)
+            if bad_stages:
+                failed = True
+                print("\tFAIL %s: %s" % (name, ", ".join(sorted(bad_stages))))
+            else:
+                print("\tok   " + name)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
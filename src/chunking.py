@@ -0,0 +1,23 @@
+"""A module for splitting lists into request-sized chunks.
+
+Kept apart from the modules that use it, so that the API clients don't have
+to import the playlist models (and connect to Mongo) just to chunk a list.
+
+author: Soobeen Park
+file: chunking.py
+"""
+
+from typing import List
+
+
+def chunked(items, size) -> List[List]:
+    """Splits items into consecutive chunks of at most size items.
+
+    Args:
+        items (list): The items to split.
+        size (int): Maximum number of items per chunk.
+
+    Return:
+        list: The list of chunks.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""Keeps Spotify playlists up to date from [FRESH] tagged Reddit posts.
+
+A long-running alternative to running main.py from cron. The API clients,
+tokens and caches stay warm for as long as the daemon runs, and new posts
+are ingested as they are submitted instead of once an hour. The more
+expensive upvote refreshes and playlist updates run on their own intervals.
+
+SIGTERM (or SIGINT) stops the daemon once the current pass is done.
+
+usage: ./daemon.py [--poll-interval SECONDS] [--upvote-interval MINUTES]
+                   [--playlist-interval MINUTES]
+
+author: Soobeen Park
+file: daemon.py
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import logging
+import os
+import signal
+import threading
+import time
+
+# Has to be imported before any model connects to Mongo
+from metrics import METRICS
+from checkindexes import ensure_indexes
+from freshtracks import FreshTracks
+from main import SUBREDDIT_SETTINGS
+from redditcli import RedditCli
+from spotifycli import SpotifyCli
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_upvotes(freshtracks):
+    """Refreshes upvotes on the subreddit's posts from past week."""
+    with freshtracks.stage("refresh_upvotes"):
+        freshtracks.refresh_upvotes()
+
+
+class FreshTracksDaemon:
+    """Runs FreshTracks for all subreddits until stopped."""
+
+    def __init__(self, subreddit_settings, rcli, scli, poll_interval=30,
+                 upvote_interval=15 * 60, playlist_interval=15 * 60):
+        """Instantiates the daemon.
+
+        Args:
+            subreddit_settings (list): Info needed for each subreddit.
+            rcli (RedditCli): Reddit client shared by all subreddits.
+            scli (SpotifyCli): Spotify client shared by all subreddits.
+            poll_interval (float): Seconds to wait between checks for new
+                posts.
+            upvote_interval (float): Seconds between upvote refreshes.
+            playlist_interval (float): Seconds between playlist updates.
+        """
+        self.settings = {s["subreddit_name"]: s for s in subreddit_settings}
+        # Reddit may spell subreddit names in a different case
+        self.names = {name.lower(): name for name in self.settings}
+        self.rcli = rcli
+        self.scli = scli
+        self.poll_interval = poll_interval
+        self.upvote_interval = upvote_interval
+        self.playlist_interval = playlist_interval
+
+        self.stopping = threading.Event()
+        # time.monotonic() of the start of the last pass of each kind
+        self.last_upvote_refresh = None
+        self.last_playlist_sync = None
+        # Subreddits whose new posts have to be retrieved from their listing,
+        # since the stream may have missed some
+        self.needs_catch_up = set(self.settings)
+        # Creation time (tzaware) of the newest post ingested per subreddit
+        self.cutoffs = dict()
+
+    def stop(self, signum=None, frame=None):
+        """Asks the daemon to stop once the current pass is done."""
+        print("Stopping once the current pass is done")
+        self.stopping.set()
+
+    def for_each_subreddit(self, pass_name, fn, subreddit_names) -> set:
+        """Runs a pass over each subreddit in parallel.
+
+        A fresh FreshTracks is made for each pass, so that its idea of the
+        current time is up to date, while the clients are shared.
+
+        Args:
+            pass_name (str): Name of the pass, to report failures with.
+            fn (function): Takes the FreshTracks of a subreddit.
+            subreddit_names (Iterable[str]): The subreddits to run.
+
+        Return:
+            set: The names of the subreddits that failed.
+        """
+        def run(subreddit_name):
+            freshtracks = FreshTracks(self.settings[subreddit_name],
+                                      self.rcli, self.scli)
+            try:
+                fn(freshtracks)
+            finally:
+                METRICS.emit(subreddit_name, freshtracks.stage_times)
+
+        subreddit_names = list(subreddit_names)
+        if not subreddit_names:
+            return set()
+        with ThreadPoolExecutor(max_workers=len(subreddit_names)) \
+                as executor:
+            futures = {subreddit_name: executor.submit(run, subreddit_name)
+                       for subreddit_name in subreddit_names}
+
+        # A failed subreddit doesn't stop the others
+        failed = set()
+        for subreddit_name, future in futures.items():
+            e = future.exception()
+            if e:
+                print("Exception caught in %s of r/%s: %s"
+                      % (pass_name, subreddit_name, e))
+                logger.error("Failed %s of r/%s", pass_name, subreddit_name,
+                             exc_info=e)
+                failed.add(subreddit_name)
+        return failed
+
+    def catch_up(self):
+        """Ingests the posts of subreddits from their listings.
+
+        The listings are paged from each subreddit's Checkpoint, which picks
+        up the posts submitted while the daemon wasn't streaming them.
+        """
+        def ingest(freshtracks):
+            freshtracks.ingest()
+            _, self.cutoffs[freshtracks.subreddit_name] = \
+                freshtracks.get_cutoff()
+
+        print("Catching up on r/" + ", r/".join(sorted(self.needs_catch_up)))
+        self.needs_catch_up = self.for_each_subreddit(
+            "catch up", ingest, self.needs_catch_up)
+
+    def ingest_streamed(self, submissions):
+        """Ingests streamed posts, routing each to its subreddit.
+
+        Args:
+            submissions (list): Posts of any of the subreddits, oldest first.
+        """
+        new_posts = dict()
+        for submission in submissions:
+            subreddit_name = self.names.get(
+                submission.subreddit.display_name.lower())
+            if subreddit_name is None or \
+                    subreddit_name in self.needs_catch_up:
+                continue
+            created_utc = datetime.fromtimestamp(submission.created_utc,
+                                                 tz=timezone.utc)
+            # The stream starts with posts that may already be ingested
+            cutoff = self.cutoffs.get(subreddit_name)
+            if cutoff and created_utc <= cutoff:
+                continue
+            new_posts.setdefault(subreddit_name, []).append(submission)
+
+        def ingest(freshtracks):
+            posts = new_posts[freshtracks.subreddit_name]
+            freshtracks.ingest(posts)
+            self.cutoffs[freshtracks.subreddit_name] = datetime.fromtimestamp(
+                posts[-1].created_utc, tz=timezone.utc)
+
+        # Posts of failed subreddits would be lost, so retrieve them again
+        self.needs_catch_up |= self.for_each_subreddit("ingest", ingest,
+                                                       new_posts)
+
+    def run_due_passes(self):
+        """Runs the upvote refresh and playlist update, if they are due."""
+        now = time.monotonic()
+        if self.last_upvote_refresh is None or \
+                now - self.last_upvote_refresh >= self.upvote_interval:
+            self.last_upvote_refresh = now
+            self.for_each_subreddit("refresh_upvotes", refresh_upvotes,
+                                    self.settings)
+
+        if self.last_playlist_sync is None or \
+                now - self.last_playlist_sync >= self.playlist_interval:
+            self.last_playlist_sync = now
+            self.for_each_subreddit("sync_playlist",
+                                    lambda ft: ft.sync_playlist(),
+                                    self.settings)
+
+    def run(self):
+        """Runs until stop() is called."""
+        stream = None
+        while not self.stopping.is_set():
+            if self.needs_catch_up:
+                self.catch_up()
+
+            if stream is None:
+                stream = self.rcli.stream_new(list(self.settings))
+
+            # Take the posts from the stream's last request
+            submissions = []
+            try:
+                for submission in stream:
+                    if submission is None:
+                        break
+                    submissions.append(submission)
+            except Exception as e:
+                # Start a new stream, and catch up on anything missed
+                print("Exception caught in stream: " + str(e))
+                logger.error("Failed to stream new posts", exc_info=e)
+                stream = None
+                self.needs_catch_up = set(self.settings)
+
+            if submissions:
+                self.ingest_streamed(submissions)
+
+            self.run_due_passes()
+
+            # Requests made outside of the subreddits' passes
+            METRICS.emit(None, dict())
+
+            self.stopping.wait(self.poll_interval)
+
+        # Persist any search results not written yet
+        self.scli.search_cache.flush()
+        print("Stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--poll-interval", type=float, default=30,
+                        help="seconds between checks for new posts "
+                             "(default: 30)")
+    parser.add_argument("--upvote-interval", type=float, default=15,
+                        help="minutes between upvote refreshes (default: 15)")
+    parser.add_argument("--playlist-interval", type=float, default=15,
+                        help="minutes between playlist updates (default: 15)")
+    args = parser.parse_args()
+
+    # Setup directory for logging files
+    log_files_path = "../tmp/"
+    if not os.path.exists(log_files_path):
+        os.makedirs(log_files_path)
+
+    # Setup logger to log any exceptions
+    log_format_str = "%(asctime)s %(levelname)s %(name)s %(message)s"
+    logging.basicConfig(filename=log_files_path + "error.log",
+                        level=logging.ERROR,
+                        format=log_format_str)
+
+    ensure_indexes()
+
+    daemon = FreshTracksDaemon(
+        SUBREDDIT_SETTINGS, RedditCli("bot1", "basic"), SpotifyCli(),
+        poll_interval=args.poll_interval,
+        upvote_interval=args.upvote_interval * 60,
+        playlist_interval=args.playlist_interval * 60)
+
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+
+    daemon.run()
+
+
+if __name__ == "__main__":
+    main()
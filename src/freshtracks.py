@@ -6,45 +6,111 @@ author: Soobeen Park
 file: freshtracks.py
 """
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
 import pdb
 import pprint
-import re
-from typing import List
+from typing import Iterator, List
 import sys
-import time
 
-import pymodm
 import pymongo
-from pymongo.errors import DuplicateKeyError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 import pytz
 
 from redditcli import RedditCli
-from spotifycli import SpotifyCli
+from spotifycli import SpotifyCli, parse_spotify_link
+from playlistsync import plan_playlist, OrderedPlaylist, PlaylistMutations
+from pipeline import Feed, Pipeline, batched
+from stages import current_stage, stage, in_current_stage
+from titleparser import TitleParser
+import titleparser
 from models.post import Post
 from models.playlisttrack import PlaylistTrack
+from models.albumpopularity import AlbumPopularity
+from models.checkpoint import Checkpoint
+from models.playlistsnapshot import PlaylistSnapshot
+
+# How often to look up an album's most popular track again, as
+# (max post age, recheck interval) pairs. The last entry applies to all older
+# posts.
+POPULARITY_RECHECK_SCHEDULE = [
+    (timedelta(days=1), timedelta(hours=1)),
+    (timedelta(days=3), timedelta(hours=6)),
+    (None, timedelta(days=1)),
+]
+POPULARITY_RECHECK_SLACK = timedelta(minutes=10)
+
+# Mongo's error code for a write that violates a unique index
+DUPLICATE_KEY_ERROR = 11000
+
+
+def new_ingest_counts() -> dict:
+    """Counters of the posts of a single ingest(), all zero."""
+    return {"saved": 0, "skipped": 0, "prepared": 0, "linked": 0,
+            "searches": Counter()}
 
 
 class FreshTracks:
     """Class that contains most of the meat of the program."""
 
-    def __init__(self, subreddit_setting):
+    def __init__(self, subreddit_setting, rcli=None, scli=None, now=None,
+                 profiler=None):
         """Instantiates FreshTracks.
 
         Args:
             subreddit_setting (dict): Info needed for each subreddit.
+            rcli (RedditCli): Reddit client to use. A new one is created if
+                not given.
+            scli (SpotifyCli): Spotify client to use. A new one is created if
+                not given.
+            now (datetime): Time to run as of (tzaware). Defaults to the
+                current time.
+            profiler (StageProfiler): Profiler to run each stage under, if
+                any.
         """
-        self.rcli = RedditCli("bot1", "basic")
-        self.scli = SpotifyCli()
+        self.rcli = rcli or RedditCli("bot1", "basic")
+        self.scli = scli or SpotifyCli()
         self.subreddit_name = subreddit_setting["subreddit_name"]
         self.upvote_thresh = subreddit_setting["upvote_thresh"]
         self.playlist_id = subreddit_setting["playlist_id"]
+        self.title_parser = TitleParser(self.subreddit_name)
+        # In-memory model of the playlist, loaded once per run
+        self.playlist = None
+        # Changes to the Spotify playlist, sent at once by
+        # apply_playlist_mutations()
+        self.mutations = PlaylistMutations()
+        # Whether the playlist may be rewritten in full when that takes fewer
+        # requests than moving tracks (resets the tracks' "added date")
+        self.allow_playlist_rewrite = subreddit_setting.get(
+            "allow_playlist_rewrite", False)
+        # Number of posts to search for in Spotify at the same time
+        self.search_workers = subreddit_setting.get("search_workers", 4)
+        # Number of posts each stage of the retrieve -> parse -> resolve ->
+        # save pipeline works on at once, and max number of posts waiting
+        # between two stages
+        self.stream_batch_size = subreddit_setting.get("stream_batch_size",
+                                                       20)
+        self.stream_buffer_size = subreddit_setting.get(
+            "stream_buffer_size", 100)
+
+        # Wall time of each stage of run(), in seconds
+        self.stage_times = dict()
+        self.profiler = profiler
 
         # How far ago we go to keep tracks active in playlist (ie. one week)
-        self.one_week_ago = datetime.now(timezone.utc) - timedelta(weeks=1)
+        self.now = now or datetime.now(timezone.utc)
+        self.one_week_ago = self.now - timedelta(weeks=1)
 
         # Get the date and time of the most recently added [FRESH] track
         self.last_accessed_time = self.get_last_accessed_time()
+        # Posts retrieved, resolved and saved by ingest(), reported once it
+        # is done
+        self.ingest_counts = new_ingest_counts()
+        # Newest submission retrieved this run, saved once its posts are
+        self.new_checkpoint = None
 
     def get_last_accessed_time(self) -> datetime:
         """Retrieve most recent datetime that is stored in the database.
@@ -69,27 +135,149 @@ class FreshTracks:
             # If no results in database, set last accessed to 1 week ago
             last_accessed_time = self.one_week_ago
 
-        print("\tLast accessed: ", last_accessed_time)
+        self.log("\tLast accessed: ", last_accessed_time)
         return last_accessed_time
 
-    def get_playlisttracks_ordered(self) -> pymodm.queryset.QuerySet:
+    def get_playlisttracks_ordered(self) -> List[PlaylistTrack]:
         """Helper method to get the tracks currently in the playlist
 
+        Joins each post in the playlist with its PlaylistTrack in a single
+        aggregation, so that the posts don't have to be dereferenced one by
+        one afterwards.
+
         Return:
-            QuerySet: All tracks in playlist in sorted order.
+            list: All tracks in playlist in sorted order, with their posts.
         """
-        # Get all posts from subreddit that are in playlist
-        posts = Post.objects.raw(
-            {"subreddit": self.subreddit_name, "exists_in_playlist": True})
+        pipeline = [
+            # Get all posts from subreddit that are in playlist
+            {"$match": {"subreddit": self.subreddit_name,
+                        "exists_in_playlist": True}},
+            {"$lookup": {"from": PlaylistTrack._mongometa.collection_name,
+                         "localField": "_id",
+                         "foreignField": "_id",
+                         "as": "playlisttrack"}},
+            {"$unwind": "$playlisttrack"},
+            # Get all tracks in playlist in order
+            {"$sort": {"playlisttrack.playlist_position": pymongo.ASCENDING}},
+        ]
+
+        playlisttracks = []
+        for doc in Post._mongometa.collection.aggregate(pipeline):
+            playlist_position = doc.pop("playlisttrack")["playlist_position"]
+            playlisttracks.append(PlaylistTrack(
+                post=Post.from_document(doc),
+                playlist_position=playlist_position))
 
-        ids = [p.reddit_post_id for p in posts]
+        return playlisttracks
 
-        # Get all tracks in playlist in order
-        playlisttracks = PlaylistTrack.objects \
-            .raw({"_id": {"$in": ids}}) \
-            .order_by([("playlist_position", pymongo.ASCENDING)])
+    def get_cutoff(self) -> tuple:
+        """Gets the newest post of the subreddit seen by the last run.
 
-        return playlisttracks
+        Returns:
+            tuple: The fullname of the subreddit's Checkpoint (None if there
+                is none yet) and the tzaware time to fall back to if that
+                post can't be found, ie. the checkpoint's creation time, or
+                else the last accessed time.
+        """
+        try:
+            checkpoint = Checkpoint.objects.get({"_id": self.subreddit_name})
+        except Checkpoint.DoesNotExist:
+            return None, self.last_accessed_time
+
+        return checkpoint.fullname, \
+            pytz.utc.localize(checkpoint.created_utc)  # tzaware
+
+    def retrieve_new(self) -> Iterator:
+        """Retrieve the new posts of the subreddit from its own listing.
+
+        New posts are paged from the subreddit's Checkpoint, ie. the newest
+        submission seen by the last run whether or not it was saved. If there
+        is no checkpoint yet, or its submission was deleted, posts are
+        retrieved by creation time instead.
+
+        Return:
+            Iterator: Yields the new posts, oldest first when paged from the
+                checkpoint, and newest first otherwise.
+        """
+        fullname, last_accessed_time = self.get_cutoff()
+        new_posts = None
+        if fullname:
+            new_posts = self.rcli.retrieve_before(fullname,
+                                                  self.subreddit_name)
+            if new_posts is None:
+                self.log("\tCheckpoint " + fullname + " is gone, "
+                         "retrieving posts by time")
+        if new_posts is None:
+            new_posts = self.rcli.retrieve_since(last_accessed_time,
+                                                 self.subreddit_name)
+        return new_posts
+
+    def retrieve_new_fresh(self, new_posts=None) -> Iterator:
+        """Retrieve all fresh posts in subreddit since script was last run.
+
+        The newest post retrieved becomes the new Checkpoint, to be saved
+        once the posts are.
+
+        Args:
+            new_posts (Iterable): New posts of the subreddit, in any order,
+                if already being retrieved (see main.retrieve_combined()). If
+                it is a Feed that finishes incomplete, the rest of the posts
+                are retrieved with retrieve_new().
+
+        Yields:
+            praw.models.Submission: The new posts tagged FRESH.
+        """
+        if new_posts is None:
+            new_posts = self.retrieve_new()
+
+        self.new_checkpoint = None
+        newest_created_utc = None
+        seen = set()
+
+        def take(post):
+            """Counts post as retrieved, unless it already was."""
+            nonlocal newest_created_utc
+            if post.fullname in seen:
+                return False
+            seen.add(post.fullname)
+
+            created_utc = datetime.fromtimestamp(post.created_utc,
+                                                 tz=timezone.utc)
+            # Ties go to the post retrieved last, which is the newer one
+            # when paging from the checkpoint
+            if newest_created_utc is None or \
+                    created_utc >= newest_created_utc:
+                newest_created_utc = created_utc
+                self.new_checkpoint = Checkpoint(
+                    subreddit=self.subreddit_name, fullname=post.fullname,
+                    created_utc=created_utc)
+            return True
+
+        for post in new_posts:
+            if take(post) and self.rcli.is_fresh(post):
+                yield post
+
+        if isinstance(new_posts, Feed) and not new_posts.complete:
+            for post in self.retrieve_new():
+                if take(post) and self.rcli.is_fresh(post):
+                    yield post
+
+        self.log("\tRetrieved %d posts" % len(seen))
+
+    def save_checkpoint(self):
+        """Saves the newest submission retrieved this run as Checkpoint."""
+        if self.new_checkpoint:
+            self.new_checkpoint.save()
+
+    def log(self, *args):
+        """Prints a progress line, prefixed with the subreddit's name.
+
+        Several subreddits run at the same time, so their lines interleave.
+
+        Args:
+            *args: What to print, as with print().
+        """
+        print("r/" + self.subreddit_name + " ".join(str(a) for a in args))
 
     def print_current_playlist(self):
         """Helper method to print out playlist in order.
@@ -110,29 +298,7 @@ class FreshTracks:
         Return:
             dict: A dictionary containing parsed information from the arg.
         """
-        desc_regex = re.compile(r"""^Listen\ to\s
-                (?P<title>.+)\s                 # Title
-                on\ Spotify.\s
-                (?P<artist>.+)\s                # Artist
-                (·)?\s
-                (?P<type>\w+)\s                 # Type
-                (·)?\s
-                (?P<year>\d+)                   # Year
-                (\s·\s(?P<num_songs>\d+)\ssongs)?    # Num songs (if exist)
-                .$""", re.VERBOSE)
-        match = desc_regex.search(media_description_str)
-
-        if match:
-            # Regex properly parsed
-            gd = match.groupdict()
-            if gd.get("num_songs", None) is None:
-                gd["num_songs"] = 1
-
-        else:
-            # Return empty dict for fail to parse
-            return dict()
-
-        return gd
+        return titleparser.parse_embedded_media(media_description_str)
 
     def parse_post_title_wo_FRESH(self, freshtype, title_str) -> dict:
         """Parses the post title, that does not contain [FRESH (___)] in title.
@@ -145,47 +311,7 @@ class FreshTracks:
             dict: A dictionary containing parsed information from the arg.
                 If parsing failed or invalid freshtype, empty dict is returned.
         """
-        # Exit early if not a valid freshtype in title
-        if not freshtype or not self.is_valid_freshtype(freshtype):
-            return dict()
-
-        # The regex below is divided into 2 different artist-title groups to
-        # account for any dashes/hyphens in the artist or title names
-        title_regex = re.compile(r"""
-            ((?P<artist1>.+)\s?                         # Artist1
-            -\s?
-            (?P<title1>.+)                              # Title1
-            |
-            (?P<artist2>.+)                             # Artist2
-            -
-            (?P<title2>.+))                             # Title 2
-            """, re.VERBOSE | re.IGNORECASE)
-        match = title_regex.search(title_str)
-
-        return_dict = dict()
-        if match:
-            # Regex properly parsed
-            gd = match.groupdict()
-
-            if gd["artist1"]:     # Regex matched artist1-title1 groups
-                assert(gd["title1"])
-                gd["artist"] = gd["artist1"]
-                gd["title"] = gd["title1"]
-            else:           # Regex matched artist2-title2 groups
-                assert(gd["artist2"] and gd["title2"])
-                gd["artist1"] = gd["artist2"]
-                gd["title1"] = gd["title2"]
-
-            return_dict["artist"] = re.sub(
-                r"\(.*\)", "", gd["artist1"]).strip()
-            return_dict["title"] = re.sub(r"\(.*\)", "", gd["title1"]).strip()
-            return_dict["freshtype"] = freshtype
-
-            # Exit early if parsed artist or title is empty
-            if not return_dict["artist"] or not return_dict["title"]:
-                return dict()
-
-        return return_dict
+        return titleparser.parse_title_wo_fresh(freshtype, title_str)
 
     def parse_post_title_with_FRESH(self, title_str) -> dict:
         """Parses the post title with FRESH in the title.
@@ -200,56 +326,14 @@ class FreshTracks:
             dict: A dictionary containing parsed information from the arg.
                 If parsing failed or invalid freshtype, empty dict is returned.
         """
-
-        # The regex below is divided into 2 different artist-title groups to
-        # account for any dashes/hyphens in the artist or title names
-        title_regex = re.compile(r"""
-            \[\s*(?P<freshtype>fresh\s*\w*)\s*\]\s*     # FRESH type
-            ((?P<artist1>.+)\s?                         # Artist1
-            -\s?
-            (?P<title1>.+)                              # Title1
-            |
-            (?P<artist2>.+)                             # Artist2
-            -
-            (?P<title2>.+))                             # Title 2
-            """, re.VERBOSE | re.IGNORECASE)
-        match = title_regex.search(title_str)
-
-        return_dict = dict()
-        if match:
-            # Regex properly parsed
-            gd = match.groupdict()
-
-            # Exit early if not a valid freshtype in title
-            if not self.is_valid_freshtype(gd["freshtype"]):
-                return dict()
-
-            if gd["artist1"]:     # Regex matched artist1-title1 groups
-                assert(gd["title1"])
-                gd["artist"] = gd["artist1"]
-                gd["title"] = gd["title1"]
-            else:           # Regex matched artist2-title2 groups
-                assert(gd["artist2"] and gd["title2"])
-                gd["artist1"] = gd["artist2"]
-                gd["title1"] = gd["title2"]
-
-            return_dict["artist"] = re.sub(
-                r"\(.*\)", "", gd["artist1"]).strip()
-            return_dict["title"] = re.sub(r"\(.*\)", "", gd["title1"]).strip()
-            return_dict["freshtype"] = gd["freshtype"]
-
-            # Exit early if parsed artist or title is empty
-            if not return_dict["artist"] or not return_dict["title"]:
-                return dict()
-
-        return return_dict
+        return titleparser.parse_title_with_fresh(title_str)
 
     def is_valid_freshtype(self, freshtype) -> bool:
         """Checks if the tag used in [FRESH ___] is a "valid" type.
 
         We are only interested in processing valid freshtypes.
         For a list of valid freshtypes, see the documentation for
-        prepare_fresh_for_search()
+        parse_fresh()
 
         Args:
             freshtype (str): The freshtype tagged in the reddit post.
@@ -257,15 +341,7 @@ class FreshTracks:
         Returns:
             bool: True if valid freshtype, false if otherwise.
         """
-        freshtype_lower = freshtype.lower()
-        valid_qualifiers = ["album", "ep", "single", "stream"]
-
-        if freshtype_lower == "fresh":
-            return True
-        elif any(vq in freshtype_lower for vq in valid_qualifiers):
-            return True
-        else:
-            return False
+        return titleparser.is_valid_freshtype(freshtype)
 
     def has_embedded_media(self, post) -> bool:
         """Helper method to check if post has embedded media we can use.
@@ -289,6 +365,21 @@ class FreshTracks:
             return False
         return True
 
+    def get_spotify_link(self, post):
+        """Helper method to find the Spotify track/album the post links to.
+
+        Args:
+            post (json): The Reddit post submission.
+
+        Return:
+            tuple: The (type, id) of the linked Spotify track or album, or
+                None if the post doesn't link to one.
+        """
+        link = parse_spotify_link(getattr(post, "url", None))
+        if not link and post.media and "oembed" in post.media:
+            link = parse_spotify_link(post.media["oembed"].get("html"))
+        return link
+
     def parse_fresh(self, fresh_posts) -> List:
         """Parses the post details so that they are ready to search in Spotify.
 
@@ -306,7 +397,10 @@ class FreshTracks:
 
         The function only stores "valid" posts tagged [FRESH], [FRESH ALBUM],
         [FRESH EP], [FRESH SINGLE], or [FRESH STREAM] into the database,
-        since we aren't interested in videos.
+        since we aren't interested in videos. Posts that link to a Spotify
+        track or album are kept even if their title can't be parsed, since
+        they are resolved from the link instead (with a None artist and
+        title).
 
         Note that these conventions differ according to the subreddit, so it is
         advised to check the rules of the specific subreddit to make sure this
@@ -317,39 +411,39 @@ class FreshTracks:
                                 in the title, to be prepared.
 
         Returns:
-            list: A list containing parsed dictionary of each post per element.
+            list: A list containing parsed dictionary of each post per element,
+                oldest post first.
         """
         # List of dict containing necessary information to search in Spotify
         prepared_posts = []
 
+        # Posts arrive oldest first when paged from the checkpoint, but newest
+        # first from retrieve_since() or the combined listing. Sort them
+        # oldest first, so that of several posts of the same album in a
+        # batch, save_posts() keeps the oldest whatever the source, as it
+        # does across batches paged from the checkpoint.
+        fresh_posts = sorted(fresh_posts,
+                             key=lambda post: (post.created_utc, post.id))
+        entries = []
         for post in fresh_posts:
-            parsed_dict = dict()
-
-            if self.has_embedded_media(post):
-                # Artist and Title already provided by Spotify in Reddit
-                # embedded media. Just simply capture that string.
-                parsed_dict = self.parse_post_embdedded_media(
-                    post.media["oembed"]["description"])
-
-            if not parsed_dict:
-                # Post doesn't have appropriate embedded media.
-                # Have to parse Artist and Title from post title,
-                # then search if that combo exists in Spotify.
-                if self.subreddit_name in ("indieheads", "hiphopheads"):
-                    parsed_dict = self.parse_post_title_with_FRESH(post.title)
-
-                elif self.subreddit_name in ("popheads") and \
-                        "link_flair_text" in vars(post):
-                    parsed_dict = self.parse_post_title_wo_FRESH(
-                        post.link_flair_text, post.title)
-
-                else:
-                    raise Exception("Select parsing method for subreddit " +
-                                    self.subreddit_name)
-
+            # If the post has embedded media, artist and title are already
+            # provided by Spotify. Otherwise, they have to be parsed from the
+            # post title (or flair), then searched for in Spotify.
+            desc = post.media["oembed"]["description"] \
+                if self.has_embedded_media(post) else None
+            flair = vars(post).get("link_flair_text")
+            entries.append((post.title, flair, desc))
+
+        parsed_dicts = self.title_parser.parse_many(entries)
+
+        for post, parsed_dict in zip(fresh_posts, parsed_dicts):
+            spotify_link = self.get_spotify_link(post)
             if not parsed_dict:
-                # If no match able to be parsed, discard this post
-                continue
+                if not spotify_link:
+                    # If no match able to be parsed, discard this post
+                    continue
+                # The link says what the post is, without its title
+                parsed_dict = {"artist": None, "title": None}
 
             # Add rest of relevant values
             parsed_dict["reddit_post_id"] = post.id
@@ -357,11 +451,71 @@ class FreshTracks:
             parsed_dict["ups"] = post.ups
             # Add this for ease of processing later
             parsed_dict["has_embedded_media"] = self.has_embedded_media(post)
+            parsed_dict["spotify_link"] = spotify_link
 
             prepared_posts.append(parsed_dict)
 
         return prepared_posts
 
+    def populate_post(self, prepared_post, resolved, tally=None) -> dict:
+        """Populates a single prepared post with Spotify details.
+
+        Args:
+            prepared_post (dict): The post that was prepared to search with.
+            resolved (dict): The populated dicts of the Spotify links resolved
+                by SpotifyCli.resolve_links().
+            tally (collections.Counter): If given, counts where each search
+                response came from (see SpotifyCli.search()).
+
+        Return:
+            dict: The populated Spotify information for the post, or an empty
+                dict if it couldn't be found in Spotify.
+        """
+        # Store the result in searched
+        searched = dict()
+
+        artist = prepared_post["artist"]
+        title = prepared_post["title"]
+
+        if prepared_post["spotify_link"] in resolved:
+            searched = dict(resolved[prepared_post["spotify_link"]])
+
+        elif artist is None:
+            # Only the link said what the post is, and it didn't resolve
+            return dict()
+
+        elif not prepared_post["has_embedded_media"]:
+            # First try to search based as a track
+            search_resp = self.scli.search(artist, title, "track", tally)
+            items = search_resp["tracks"]["items"]
+            if items:
+                item = items[0]
+                searched = self.scli.populate_from_track(item)
+
+        if not searched:
+            # Search by track above didn't get applied, because either has
+            # embedded media or search by track failed. So now search by
+            # album.
+            search_resp = self.scli.search(artist, title, "album", tally)
+            items = search_resp["albums"]["items"]
+            if items:
+                item = items[0]
+                searched = self.scli.populate_from_album(item)
+
+        if not searched:
+            # If still not populated, then this discard this post.
+            return dict()
+
+        # Finally add some of the existing relevant data in to the dict to
+        # add
+        searched["reddit_post_id"] = prepared_post["reddit_post_id"]
+        searched["created_utc"] = prepared_post["created_utc"]
+        searched["upvotes"] = prepared_post["ups"]
+        searched["parsed_artist"] = artist
+        searched["parsed_title"] = title
+
+        return searched
+
     def search_and_populate_posts(self, prepared_posts) -> List:
         """Call to Spotify search() to populate each post dict with Spotify
         details.
@@ -376,6 +530,10 @@ class FreshTracks:
             - album_type (one from {single, album, compilation})
             - spotify_album_uri
 
+        Posts that link to a Spotify track or album are resolved directly from
+        the link in batches, and only the rest are searched for, with up to
+        search_workers posts being searched at the same time.
+
         Args:
             spot (spotify.Spotify): Initialized Spotify client.
             prepared_posts (list): The list that was prepared to search with.
@@ -385,303 +543,562 @@ class FreshTracks:
                 the populated Spotify information for each post.
         """
         populated_posts = []
-
-        for prepared_post in prepared_posts:
-            # Store the result in searched
-            searched = dict()
-
-            artist = prepared_post["artist"]
-            title = prepared_post["title"]
-
-            if not prepared_post["has_embedded_media"]:
-                # First try to search based as a track
-                search_resp = self.scli.search(artist, title, "track")
-                items = search_resp["tracks"]["items"]
-                if items:
-                    item = items[0]
-                    searched = self.scli.populate_from_track(item)
-
-            if not searched:
-                # Search by track above didn't get applied, because either has
-                # embedded media or search by track failed. So now search by
-                # album.
-                search_resp = self.scli.search(artist, title, "album")
-                items = search_resp["albums"]["items"]
-                if items:
-                    item = items[0]
-                    searched = self.scli.populate_from_album(item)
-
-            if not searched:
-                # If still not populated, then this discard this post.
-                continue
-
-            # Finally add some of the existing relevant data in to the dict to
-            # add
-            searched["reddit_post_id"] = prepared_post["reddit_post_id"]
-            searched["created_utc"] = prepared_post["created_utc"]
-            searched["upvotes"] = prepared_post["ups"]
-            searched["parsed_artist"] = artist
-            searched["parsed_title"] = title
-
-            # Add to list
-            populated_posts.append(searched)
+        # Where this call's searches came from. Each post gets its own tally,
+        # since the caches are shared with other subreddits' threads.
+        searches = Counter()
+
+        def populate(prepared_post):
+            tally = Counter()
+            return self.populate_post(prepared_post, resolved, tally), tally
+
+        # Posts that link to Spotify are resolved directly from the link, all
+        # at once, without searching
+        links = [pp["spotify_link"] for pp in prepared_posts
+                 if pp["spotify_link"]]
+        resolved = self.scli.resolve_links(links)
+
+        # Resolve the remaining posts in parallel. map() keeps the results in
+        # the same order as prepared_posts, so which of two posts of the same
+        # album gets saved doesn't depend on which resolved first.
+        with ThreadPoolExecutor(max_workers=self.search_workers) as executor:
+            for searched, tally in executor.map(self.in_stage(populate),
+                                                prepared_posts):
+                searches.update(tally)
+                if searched:
+                    populated_posts.append(searched)
+
+        self.scli.search_cache.flush()
+        # Reported by ingest(), once all batches are resolved
+        counts = self.ingest_counts
+        counts["prepared"] += len(prepared_posts)
+        counts["linked"] += sum(pp["spotify_link"] in resolved
+                                for pp in prepared_posts)
+        counts["searches"].update(searches)
 
         return populated_posts
 
     def save_posts(self, posts_to_insert):
         """Saves the posts as documents in the Posts collection.
 
+        All posts are sent in a single unordered insert_many(). Posts that
+        already exist, or whose album already exists in the subreddit (see the
+        unique index of Post), are rejected by Mongo with a duplicate key
+        error, and skipped. Of several posts of the same album, the first one
+        is saved, which is the oldest since parse_fresh() sorts each batch
+        oldest first. Every skipped post is listed, and counted in the summary
+        printed by ingest().
+
         Args:
             posts_to_insert (list): A list of dicts, each containing
                                     info about a post.
         """
-        count = 0
+        documents = []
+        skipped = 0
+        seen_ids = set()
+        seen_albums = set()
         for p in posts_to_insert:
+            # Of several posts of the same album, only try the first one, since
+            # an unordered insert doesn't say which one would be kept
+            album = (p["spotify_album_uri"], p["subreddit"])
+            if p["reddit_post_id"] in seen_ids or album in seen_albums:
+                self.log("\t\t...Already in batch: " + p["artist"] + " - " +
+                         p["track"])
+                skipped += 1
+                continue
+            seen_ids.add(p["reddit_post_id"])
+            seen_albums.add(album)
+
             post_obj = Post(**p)
-            print("\t\t...Saving to DB: " + p["artist"] + " - " + p["track"])
+            post_obj.full_clean()
+            self.log("\t\t...Saving to DB: " + p["artist"] + " - " +
+                     p["track"])
+            documents.append(post_obj.to_son())
+
+        count = len(documents)
+        if documents:
             try:
-                # force_insert will raise DuplicateKeyError instead of
-                # quietly overwriting existing document
-                post_obj.save(force_insert=True)
-            except DuplicateKeyError:
+                Post._mongometa.collection.insert_many(documents,
+                                                       ordered=False)
+            except BulkWriteError as e:
+                errors = e.details["writeErrors"]
+                # Anything but a duplicate key is a real failure
+                if any(error["code"] != DUPLICATE_KEY_ERROR
+                       for error in errors):
+                    raise
                 # If post/album already exists, then discard this post
-                continue
-            count += 1
-        print("\tAfter filtering, saved %d posts into DB" % count)
+                for error in errors:
+                    document = documents[error["index"]]
+                    self.log("\t\t...Already in DB: " + document["artist"] +
+                             " - " + document["track"])
+                count -= len(errors)
+                skipped += len(errors)
+        # Reported by ingest(), once all batches are saved
+        self.ingest_counts["saved"] += count
+        self.ingest_counts["skipped"] += skipped
 
     def refresh_upvotes(self):
         """Refreshes upvotes on each post within past week.
+
+        Scores are looked up in batches through RedditCli.refresh_scores(), and
+        all changed counts are written back with a single bulk write.
         """
         posts_past_week = Post.objects.raw({"$and":
                                             [{"created_utc": {"$gte": self.one_week_ago}},
                                              {"subreddit": self.subreddit_name}]})
-        count = 0
-        for post in posts_past_week:
-            reddit_post_id = post.reddit_post_id
-            upvotes = self.rcli.reddit.submission(id=reddit_post_id).ups
-            post.upvotes = upvotes
-            post.save()
-            count += 1
-        print("\tRefreshed %d posts' upvotes" % count)
+        old_upvotes = {post.reddit_post_id: post.upvotes
+                       for post in posts_past_week}
+
+        scores = self.rcli.refresh_scores(old_upvotes.keys())
+
+        # Only write back the posts whose upvote count actually changed
+        updates = [UpdateOne({"_id": reddit_post_id},
+                             {"$set": {"upvotes": upvotes}})
+                   for reddit_post_id, upvotes in scores.items()
+                   if upvotes != old_upvotes[reddit_post_id]]
+        if updates:
+            Post._mongometa.collection.bulk_write(updates, ordered=False)
+
+        count = len(old_upvotes)
+        num_requests = self.rcli.info_request_count(count)
+        self.log("\tRefreshed %d posts' upvotes (%d changed) in %d requests, "
+                 "saving %d requests" % (count, len(updates), num_requests,
+                                         count - num_requests))
+
+    def load_playlist(self) -> OrderedPlaylist:
+        """Loads the in-memory model of the playlist, once per run.
+
+        The playlist's snapshot_id is checked against the one saved after
+        the last write to it, which costs a single request. Only if the
+        playlist was changed since (eg. edited by hand, or a run failed
+        halfway) is the model rebuilt from the playlist's items.
+
+        Return:
+            OrderedPlaylist: The tracks currently in the playlist.
+        """
+        if self.playlist is None:
+            self.playlist = OrderedPlaylist(self.get_playlisttracks_ordered())
+
+            snapshot_id = self.scli.get_playlist_snapshot_id(self.playlist_id)
+            try:
+                saved = PlaylistSnapshot.objects.get({"_id": self.playlist_id})
+                saved_snapshot_id = saved.snapshot_id
+            except PlaylistSnapshot.DoesNotExist:
+                saved_snapshot_id = None
+            if snapshot_id != saved_snapshot_id:
+                self.resync_playlist()
+            self.mutations.snapshot_id = snapshot_id
+        return self.playlist
+
+    def resync_playlist(self):
+        """Rebuilds the playlist model from the tracks in the playlist.
+
+        Tracks that aren't the post of a subreddit, repeats of a post, and
+        items without a track are queued to be removed from the playlist.
+        """
+        self.log("\tPlaylist changed since last run, reading it from Spotify")
+        uris = self.scli.get_playlist_track_uris(self.playlist_id)
+
+        posts_by_uri = {p.spotify_track_uri: p for p in Post.objects.raw(
+            {"subreddit": self.subreddit_name,
+             "spotify_track_uri": {"$in": [uri for uri in uris if uri]}})}
+        # Prefer the posts already in the model
+        posts_by_uri.update((p.spotify_track_uri, p) for p in self.playlist)
+
+        posts = []
+        unknown = []
+        for pos, uri in enumerate(uris):
+            post = posts_by_uri.pop(uri, None)
+            if post is None:
+                unknown.append((uri, pos))
+            else:
+                posts.append(post)
+
+        self.playlist.replace_all(posts)
+        if unknown:
+            self.mutations.remove(unknown)
+        self.log("\tFound %d tracks in the playlist, removing %d unknown "
+                 "tracks" % (len(uris), len(unknown)))
+
+    def flush_playlist(self):
+        """Writes the changes made to the playlist model back to the DB.
+
+        Also saves the playlist's snapshot_id after the changes were sent,
+        so that the next run can tell whether it was changed since.
+        """
+        if self.playlist is None:
+            return
+        count = self.playlist.flush()
+        PlaylistSnapshot(playlist_id=self.playlist_id,
+                         snapshot_id=self.mutations.snapshot_id).save()
+        self.log("\tWrote %d playlist changes to DB" % count)
 
     def remove_playlist_old(self):
         """Removes stale tracks from Playlist.
 
-        Reflects changes to both Post and PlaylistTrack document.
+        Reflects changes to the playlist model, to be written to the Post and
+        PlaylistTrack documents on flush_playlist(), and queues the removals
+        from the Spotify playlist.
 
         """
-        playlisttracks = self.get_playlisttracks_ordered()
+        playlist = self.load_playlist()
 
-        remove_count = 0
         tracks_to_remove = []
-        for i, playlisttrack in enumerate(list(playlisttracks)):
+        for i, post in enumerate(playlist):
             # tzaware
-            created_utc = pytz.utc.localize(playlisttrack.post.created_utc)
+            created_utc = pytz.utc.localize(post.created_utc)
 
-            post = playlisttrack.post
             if created_utc < self.one_week_ago or \
                     post.upvotes < self.upvote_thresh:
 
-                print("\t\t>>> Removing " + post.artist + " - " + post.track)
+                self.log("\t\t>>> Removing " + post.artist + " - " +
+                         post.track)
 
                 # Add track to remove it later
-                assert(i == playlisttrack.playlist_position)
-                tracks_to_remove.append({"uri": post.spotify_track_uri,
-                                         "positions": [i]})
+                tracks_to_remove.append((post.spotify_track_uri, i))
 
-                # Update post
-                post.exists_in_playlist = False
-                post.save()
+                # Remove from playlist model. Positions in the Spotify
+                # playlist don't shift until the tracks are removed below.
+                playlist.remove(i - (len(tracks_to_remove) - 1))
 
-                # Remove from collection
-                playlisttrack.delete()
+        # Remove all appropriate tracks from Spotify playlist at once
+        if tracks_to_remove:
+            self.mutations.remove(tracks_to_remove)
+        self.log(
+            "\tRemoved %d stale/downvoted tracks from playlist" %
+            len(tracks_to_remove))
 
-                # Final increment
-                remove_count += 1
+    def is_popularity_check_due(self, album_popularity, created_utc,
+                                now) -> bool:
+        """Checks if an album's most popular track should be looked up again.
 
-            else:
-                # Adjust playlist position
-                playlisttrack.playlist_position = i - remove_count
-                playlisttrack.save()
-
-        # Remove all appropriate tracks from Spotify playlist
-        assert(remove_count == len(tracks_to_remove))
-        self.scli.spot.playlist_remove_specific_occurrences_of_items(
-            playlist_id=self.playlist_id, items=tracks_to_remove)
-        print(
-            "\tRemoved %d stale/downvoted tracks from playlist" %
-            remove_count)
+        Albums are rechecked less often as their post ages, according to
+        POPULARITY_RECHECK_SCHEDULE.
+
+        Args:
+            album_popularity (AlbumPopularity): The cached lookup, or None if
+                the album was never looked up.
+            created_utc (datetime): Time the album's post was created (tzaware).
+            now (datetime): The current time (tzaware).
+
+        Returns:
+            bool: True if the album should be looked up, False otherwise.
+        """
+        if album_popularity is None:
+            return True
+
+        age = now - created_utc
+        for max_age, interval in POPULARITY_RECHECK_SCHEDULE:
+            if max_age is None or age < max_age:
+                break
+
+        checked_at = pytz.utc.localize(album_popularity.checked_at)
+        # Allow some slack, so that an hourly recheck isn't pushed back a
+        # whole run by the script starting a little earlier than last time
+        return now - checked_at >= interval - POPULARITY_RECHECK_SLACK
 
     def replace_album_most_popular_track(self):
         """Ensure that the most popular track of an album is in playlist.
+
+        Single-track releases are skipped, and the most popular track of each
+        album is cached in AlbumPopularity and only looked up again once due.
         """
         # Get all posts from subreddit that are in playlist
-        playlisttracks = self.get_playlisttracks_ordered()
+        playlist = self.load_playlist()
+
+        album_uris = [post.spotify_album_uri for post in playlist]
+        cached = {ap.spotify_album_uri: ap for ap in AlbumPopularity.objects
+                  .raw({"_id": {"$in": album_uris}})}
+
+        now = self.now
+        skipped_single = 0
+        skipped_cached = 0
+        to_check = []
+        for post in playlist:
+            if post.total_tracks == 1:
+                # Nothing to swap in a single
+                skipped_single += 1
+                continue
+
+            created_utc = pytz.utc.localize(post.created_utc)
+            if self.is_popularity_check_due(
+                    cached.get(post.spotify_album_uri), created_utc, now):
+                to_check.append(post.spotify_album_uri)
+            else:
+                skipped_cached += 1
+
+        # Look up all due albums at once
+        most_popular = self.scli.get_most_popular_many(to_check)
+        for album_uri, track in most_popular.items():
+            cached[album_uri] = AlbumPopularity(
+                spotify_album_uri=album_uri,
+                track=track["name"],
+                track_num=track["track_number"],
+                spotify_track_uri=track["uri"],
+                popularity=track["popularity"],
+                checked_at=now)
+            cached[album_uri].save()
 
         count = 0
-        for playlisttrack in list(playlisttracks):
-            post = playlisttrack.post
-            track = self.scli.get_most_popular(post.spotify_album_uri)
-            if not track:
+        for pos, post in enumerate(playlist):
+            album_popularity = cached.get(post.spotify_album_uri)
+            if post.total_tracks == 1 or not album_popularity:
                 # couldn't find most popular track.
                 continue
 
             # Update track if most popular changed
-            if track["uri"] != post.spotify_track_uri:
-                # Update in Spotify playlist
-                playlisttrack = list(PlaylistTrack.objects
-                                     .raw({"_id": post.reddit_post_id}))[0]
-                pos = playlisttrack.playlist_position
-
-                self.scli.replace_track_at_pos(
-                    self.playlist_id, playlisttrack.post.spotify_track_uri, track["uri"], pos)
+            if album_popularity.spotify_track_uri != post.spotify_track_uri:
+                # Update in Spotify playlist. The swaps are sent together,
+                # as one removal and as few inserts as possible.
+                self.mutations.remove([(post.spotify_track_uri, pos)])
+                self.mutations.insert(pos,
+                                      [album_popularity.spotify_track_uri])
 
                 # Update in DB
-                post.track = track["name"]
-                post.track_number = track["track_number"]
-                post.spotify_track_uri = track["uri"]
-                post.save()
-                playlisttrack.delete()
-                PlaylistTrack(post=post, playlist_position=pos).save()
+                post.track = album_popularity.track
+                post.track_num = album_popularity.track_num
+                post.spotify_track_uri = album_popularity.spotify_track_uri
+                playlist.mark_changed(post)
 
                 count += 1
 
-        print("\t%d tracks in playlist have been swapped out for the "
-              "more popular track in same album!" % count)
+        self.log("\t%d tracks in playlist have been swapped out for the "
+                 "more popular track in same album!" % count)
+        self.log("\tSkipped %d album lookups (%d cached, %d single-track "
+                 "releases)" % (skipped_cached + skipped_single,
+                                skipped_cached, skipped_single))
 
     def update_playlist_ordered(self):
         """Inserts/Updates tracks into Playlist in order.
 
         Ensures that the playlist songs are in sorted order according to their
         respective reddit upvote counts.
+
+        Rather than moving every track into place one by one, the target order
+        is reconciled with the current order (see playlistsync.plan_playlist),
+        so that only the tracks that are out of place get moved.
         """
         # Find posts to update playlist with, in order they are to be updated
-        posts = Post.objects.raw({"$and":
-                                  [{"created_utc": {"$gte": self.one_week_ago}},
-                                   {"upvotes": {"$gte": self.upvote_thresh}},
-                                      {"subreddit": self.subreddit_name}]}) \
-            .order_by([("upvotes", pymongo.DESCENDING)])
-
-        # Number of posts in playlist before inserting
-        orig_playlist_len = Post.objects.raw({
-            "exists_in_playlist": True,
-            "subreddit": self.subreddit_name}).count()
-
-        # Num songs added that are not orig in playlist
-        insert_count = 0
-
-        # Loop invariant: All items in playlist[0,i) are in sorted order
-        for new_pos, post in enumerate(list(posts)):
-            if post.exists_in_playlist:  # Reorder existing track
-                playlisttrack = list(PlaylistTrack.objects.
-                                     raw({"_id": post.reddit_post_id}))[0]
-
-                # Update playlist on Spotify
-                pos_in_spotify = playlisttrack.playlist_position
-
-                assert(pos_in_spotify < orig_playlist_len + insert_count)
-                print(
-                    "\t\t||| Reordering " +
-                    post.artist +
-                    " - " +
-                    post.track +
-                    " from " +
-                    str(pos_in_spotify) +
-                    " to " +
-                    str(new_pos))
-
-                if pos_in_spotify != new_pos:
-                    self.scli.spot.playlist_reorder_items(
-                        playlist_id=self.playlist_id,
-                        range_start=pos_in_spotify,
-                        insert_before=new_pos)
-                    time.sleep(1)  # Needed for Spotify API rate limit
-
-                # Reflect changed position of songs shifted down 1 spot
-                if pos_in_spotify > new_pos:
-                    shift_posts = Post.objects.raw(
-                        {"exists_in_playlist": True, "subreddit": self.subreddit_name})
-                    shift_ids = [sp.reddit_post_id for sp in shift_posts]
-                    PlaylistTrack.objects.raw(
-                        {"_id": {"$in": shift_ids},
-                         "playlist_position": {"$gte": new_pos, "$lt": pos_in_spotify}}) \
-                        .update({"$inc": {"playlist_position": 1}})
-
-                # Reflect changed position of songs shifted up 1 spot
-                elif pos_in_spotify < new_pos:
-                    shift_posts = Post.objects.raw(
-                        {"exists_in_playlist": True, "subreddit": self.subreddit_name})
-                    shift_ids = [sp.reddit_post_id for sp in shift_posts]
-                    PlaylistTrack.objects.raw(
-                        {"_id": {"$in": shift_ids},
-                         "playlist_position": {"$gt": pos_in_spotify, "$lte": new_pos}}) \
-                        .update({"$inc": {"playlist_position": -1}})
-
-                # Update new playlist position in DB
-                playlisttrack.playlist_position = new_pos
-                playlisttrack.save()
-
-            else:  # Insert track that didn't exist in playlist
-
-                print("\t\t<<< Inserting " + post.artist + " - " + post.track +
-                      " to position " + str(new_pos))
-
-                # Insert to Spotify playlist
-                self.scli.spot.playlist_add_items(
-                    playlist_id=self.playlist_id, items=[
-                        post.spotify_track_uri], position=new_pos)
-                time.sleep(1)  # Needed for Spotify API rate limit
-
-                # Shift all posts lower than pos down 1
-                shift_posts = Post.objects.raw(
-                    {"exists_in_playlist": True, "subreddit": self.subreddit_name})
-                shift_ids = [sp.reddit_post_id for sp in shift_posts]
-                PlaylistTrack.objects.raw(
-                    {"_id": {"$in": shift_ids},
-                     "playlist_position": {"$gte": new_pos}}) \
-                    .update({"$inc": {"playlist_position": 1}})
-
-                # Insert to collection
-                PlaylistTrack(post=post, playlist_position=new_pos) \
-                    .save(force_insert=True)
-
-                # Update post
-                post.exists_in_playlist = True
-                post.save()
-
-                insert_count += 1
-
-        print("\tInserted %d new tracks into the playlist" % insert_count)
-        print("\tThere are now %d tracks in the playlist" % len(list(posts)))
-
-    def run(self):
-        """Driver to run the whole program."""
-        # Retrieve new posts in subreddit since last time script was run
-        fresh_posts = self.rcli.retrieve_fresh(self.last_accessed_time,
-                                               self.subreddit_name)
-        print("\tRetrieved ", len(fresh_posts), " posts from ",
-              self.subreddit_name)
-
-        # Filter new posts to only those with [FRESH] tags in them
-        prepared_posts = self.parse_fresh(fresh_posts)
-
-        # Search and populate Reddit post with Spotify data
-        populated_posts = self.search_and_populate_posts(prepared_posts)
-        # Add subreddit_name to each post
-        posts_to_insert = [dict(pp, subreddit=self.subreddit_name)
-                           for pp in populated_posts]
-
-        # Save posts
-        self.save_posts(posts_to_insert)
+        posts = list(Post.objects.raw({"$and":
+                                       [{"created_utc": {"$gte": self.one_week_ago}},
+                                        {"upvotes": {"$gte": self.upvote_thresh}},
+                                           {"subreddit": self.subreddit_name}]})
+                     .order_by([("upvotes", pymongo.DESCENDING)]))
+
+        # Current playlist order
+        playlist = self.load_playlist()
+        current = playlist.ids()
+        current_pos = playlist.positions()
+
+        # Break upvote ties by current position, so that tied tracks are not
+        # needlessly swapped around between runs
+        posts.sort(key=lambda p: (-p.upvotes,
+                                  current_pos.get(p.reddit_post_id,
+                                                  len(current))))
+        # Prefer the playlist model's posts, which hold any unflushed changes
+        posts_by_id = {p.reddit_post_id: p for p in posts}
+        posts_by_id.update((p.reddit_post_id, p) for p in playlist)
+
+        plan = plan_playlist(current, [p.reddit_post_id for p in posts],
+                             allow_rewrite=self.allow_playlist_rewrite)
+
+        # Queue the plan's changes to the Spotify playlist
+        if plan.rewrite:
+            self.log("\t\t### Rewriting playlist in %d requests instead of %d"
+                     % (plan.rewrite_calls(), plan.incremental_calls()))
+            self.mutations.replace_all(
+                [posts_by_id[k].spotify_track_uri for k in plan.target])
+        else:
+            for reddit_post_id, range_start, insert_before in plan.moves:
+                post = posts_by_id[reddit_post_id]
+                self.log("\t\t||| Reordering " + post.artist + " - " +
+                         post.track + " from " + str(range_start) +
+                         " to before " + str(insert_before))
+                self.mutations.move(range_start, insert_before)
+
+            for pos, reddit_post_ids in plan.inserts:
+                for i, reddit_post_id in enumerate(reddit_post_ids):
+                    post = posts_by_id[reddit_post_id]
+                    self.log("\t\t<<< Inserting " + post.artist + " - " +
+                             post.track + " to position " + str(pos + i))
+                self.mutations.insert(pos, [posts_by_id[k].spotify_track_uri
+                                            for k in reddit_post_ids])
+
+        # Reflect the new playlist order in the playlist model
+        playlist.replace_all(posts_by_id[k] for k in plan.target)
+        insert_count = len(plan.target) - len(current)
+
+        self.log("\tInserted %d new tracks into the playlist" % insert_count)
+        self.log("\tThere are now %d tracks in the playlist"
+                 % len(plan.target))
+
+    def apply_playlist_mutations(self):
+        """Sends the queued changes to the Spotify playlist."""
+        count = self.mutations.apply(self.scli.spot, self.playlist_id)
+        self.log("\tSent playlist changes to Spotify in %d requests" % count)
+
+    def retrieve_stage(self, new_posts=None) -> Iterator:
+        """Streams the new posts tagged FRESH, as the retrieve stage of run().
+
+        Only the time spent retrieving posts counts towards the stage's time,
+        not the time spent waiting for the next stage to take them.
 
-        # Refresh upvotes on posts from past week
-        self.refresh_upvotes()
+        Args:
+            new_posts (Iterable): New posts of the subreddit, if already
+                being retrieved.
+
+        Yields:
+            praw.models.Submission: The new posts tagged FRESH.
+        """
+        fresh_posts = self.retrieve_new_fresh(new_posts)
+        while True:
+            with self.stage("retrieve"):
+                post = next(fresh_posts, None)
+            if post is None:
+                return
+            yield post
+
+    def batched_stage(self, stage_name, fn, items) -> Iterator:
+        """Runs fn on consecutive batches of items, as a stage of run().
+
+        Only the time spent in fn counts towards the stage's time, not the
+        time spent waiting for items from the stage before.
+
+        Args:
+            stage_name (str): The name of the stage.
+            fn (function): Takes a list of items, and returns a list of
+                results (or None).
+            items (Iterable): The items to run fn on.
+
+        Yields:
+            The results of fn for every batch, in order.
+        """
+        for batch in batched(items, self.stream_batch_size):
+            with self.stage(stage_name):
+                results = fn(batch) or []
+            yield from results
+
+    @contextmanager
+    def stage(self, stage_name):
+        """Context manager to run a stage of run() in. See stages.stage().
+
+        The stage is also profiled, if a profiler was given.
+        """
+        with stage(self.subreddit_name, stage_name, self.stage_times):
+            if self.profiler is None:
+                yield
+            else:
+                with self.profiler.profile(self.subreddit_name, stage_name):
+                    yield
+
+    def in_stage(self, fn):
+        """Wraps fn to run in the calling thread's stage, from any thread.
+
+        See stages.in_current_stage(). The work is also profiled in the
+        thread that runs it, if a profiler was given, since the stage's own
+        profile only covers the thread that waits for it.
 
+        Args:
+            fn (function): The function to wrap.
+
+        Return:
+            function: The wrapped function.
+        """
+        fn = in_current_stage(fn)
+        stage_key = current_stage.get()
+        if self.profiler is None or stage_key is None:
+            return fn
+
+        def wrapper(*args, **kwargs):
+            with self.profiler.profile(*stage_key):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    def ingest(self, new_posts=None):
+        """Saves the new posts of the subreddit, with their Spotify details.
+
+        Args:
+            new_posts (Iterable): New posts of the subreddit, in any order,
+                if already being retrieved (see retrieve_new_fresh()).
+                Retrieved from the subreddit if None.
+        """
+        # Stream new posts through retrieve -> parse -> resolve -> save, so
+        # that each stage can start on the first posts while the stages
+        # before it are still working on the rest
+        self.ingest_counts = new_ingest_counts()
+        pipeline = Pipeline(buffer_size=self.stream_buffer_size)
+        pipeline.add_stage(lambda _: self.retrieve_stage(new_posts))
+        pipeline.add_stage(lambda fresh_posts: self.batched_stage(
+            "parse", self.parse_fresh, fresh_posts))
+        pipeline.add_stage(lambda prepared_posts: self.batched_stage(
+            "resolve", self.search_and_populate_posts, prepared_posts))
+        pipeline.add_stage(lambda populated_posts: self.batched_stage(
+            "save", self.save_posts,
+            (dict(pp, subreddit=self.subreddit_name)
+             for pp in populated_posts)))
+        pipeline.run()
+
+        counts = self.ingest_counts
+        self.log("\tResolved %d of %d posts from their Spotify links"
+                 % (counts["linked"], counts["prepared"]))
+        searches = counts["searches"]
+        avoided = searches["resolution_cache"] + searches["search_cache"]
+        self.log("\tSearches: %d shared between subreddits, %d from the "
+                 "search cache, %d sent to Spotify (%d Spotify searches "
+                 "avoided)" % (searches["resolution_cache"],
+                               searches["search_cache"], searches["spotify"],
+                               avoided))
+        self.log("\tAfter filtering, saved %d posts into DB (skipped %d "
+                 "duplicates)" % (counts["saved"], counts["skipped"]))
+
+        # Only skip past the new posts once they are saved
+        self.save_checkpoint()
+
+    def sync_playlist(self):
+        """Brings the playlist up to date with the saved posts."""
         # Remove stale/downvoted posts
-        self.remove_playlist_old()
+        with self.stage("remove_old"):
+            self.remove_playlist_old()
 
         # Refresh which track of an album is most popular
-        self.replace_album_most_popular_track()
+        with self.stage("replace_popular"):
+            self.replace_album_most_popular_track()
 
         # Insert/Update [FRESH] tracks in the playlist within past week
-        self.update_playlist_ordered()
+        with self.stage("update_playlist"):
+            self.update_playlist_ordered()
+
+        # Send all playlist changes to Spotify at once
+        with self.stage("apply_playlist"):
+            self.apply_playlist_mutations()
+
+        # Write all playlist changes back to the DB at once
+        with self.stage("flush_playlist"):
+            self.flush_playlist()
+
+    def run(self, new_posts=None):
+        """Driver to run the whole program.
+
+        Args:
+            new_posts (Iterable): New posts of the subreddit, in any order,
+                if already being retrieved (see retrieve_new_fresh()).
+                Retrieved from the subreddit if None.
+        """
+        limiter_stats = self.scli.limiter.stats()
+
+        self.ingest(new_posts)
+
+        # Refresh upvotes on posts from past week
+        with self.stage("refresh_upvotes"):
+            self.refresh_upvotes()
+
+        self.sync_playlist()
+
+        # Report how much Spotify rate limiting cost this run (the limiter is
+        # shared with any subreddits running at the same time)
+        stats = self.scli.limiter.stats()
+        self.log("\tSpotify rate limiting: %d throttle waits, %d throttled "
+                 "requests, %.1fs slept" % (
+                     stats["throttle_waits"] - limiter_stats["throttle_waits"],
+                     stats["throttled"] - limiter_stats["throttled"],
+                     stats["time_slept"] - limiter_stats["time_slept"]))
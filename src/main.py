@@ -6,15 +6,103 @@ author: Soobeen Park
 file: main.py
 """
 
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import sys
+# Has to be imported before any model connects to Mongo
+from metrics import METRICS
+from checkindexes import ensure_indexes
 from freshtracks import FreshTracks
+from pipeline import Feed
+from profiling import StageProfiler, profiling_requested, PROFILE_ENV_VAR
+from redditcli import RedditCli
+from spotifycli import SpotifyCli
+
+# Subreddit settings
+indieheads = {"subreddit_name": "indieheads",
+              "upvote_thresh": 20,
+              "playlist_id": "3QlWwTD13vWFH6UOTH9514"}
+hiphopheads = {"subreddit_name": "hiphopheads",
+               "upvote_thresh": 20,
+               "playlist_id": "3KwOTBOoSfymm3trVqr0oJ"}
+popheads = {"subreddit_name": "popheads",
+            "upvote_thresh": 20,
+            "playlist_id": "72aULoyZowHVuHH1kETADA"}
+SUBREDDIT_SETTINGS = [indieheads, hiphopheads, popheads]
+
+# Whether to read the new posts of all subreddits from one combined listing,
+# rather than from one listing per subreddit
+COMBINED_LISTING = True
+
+
+def retrieve_combined(freshtracks_by_name, rcli, feeds):
+    """Feeds the new posts of all subreddits from one combined listing.
+
+    Each post is put in its subreddit's feed as soon as the listing is paged
+    to it, so that the subreddits can process their first posts while the
+    rest of the listing is retrieved.
+
+    Args:
+        freshtracks_by_name (dict): FreshTracks of each subreddit, keyed by
+            subreddit name.
+        rcli (RedditCli): Reddit client shared by all subreddits.
+        feeds (dict): Feed of each subreddit, keyed by subreddit name. Each is
+            finished once its subreddit's new posts are all put, or else
+            finished as incomplete, so that the subreddit retrieves the rest
+            of its posts separately.
+    """
+    cutoffs = {subreddit_name: freshtracks.get_cutoff()
+               for subreddit_name, freshtracks in freshtracks_by_name.items()}
+    counts = {subreddit_name: 0 for subreddit_name in cutoffs}
+    try:
+        for subreddit_name, post in rcli.retrieve_combined(cutoffs):
+            if post is None:
+                feeds[subreddit_name].finish()
+                print("Retrieved %d new posts from r/%s"
+                      % (counts[subreddit_name], subreddit_name))
+            else:
+                counts[subreddit_name] += 1
+                feeds[subreddit_name].put(post)
+    finally:
+        for subreddit_name, feed in feeds.items():
+            if not feed.finished:
+                print("Combined listing didn't reach the checkpoint of r/" +
+                      subreddit_name + ", retrieving the rest separately")
+                feed.finish(complete=False)
+
+
+def run_subreddit(freshtracks, new_posts=None):
+    """Gets the FreshTracks of a single subreddit.
+
+    Args:
+        freshtracks (FreshTracks): FreshTracks of the subreddit.
+        new_posts (Feed): New posts of the subreddit, if being retrieved
+            from the combined listing.
+    """
+    print("Getting FreshTracks from r/" + freshtracks.subreddit_name)
+    try:
+        freshtracks.run(new_posts)
+    finally:
+        # Stop the combined listing from feeding a failed subreddit
+        if new_posts is not None:
+            new_posts.close()
+        METRICS.emit(freshtracks.subreddit_name, freshtracks.stage_times)
+        if freshtracks.profiler:
+            freshtracks.profiler.dump(freshtracks.subreddit_name)
+    print("Done with r/" + freshtracks.subreddit_name + "\n\n")
 
 
 def main():
     """Script to execute.
     """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--profile", action="store_true",
+                        help="profile each stage into ../tmp/profiles/ "
+                             "(or set %s=1)" % PROFILE_ENV_VAR)
+    args = parser.parse_args()
+
     # Setup directory for logging files
     log_files_path = "../tmp/"
     if not os.path.exists(log_files_path):
@@ -29,25 +117,68 @@ def main():
 
     try:
         print("==============================================")
-        # Subreddit settings
-        indieheads = {"subreddit_name": "indieheads",
-                      "upvote_thresh": 20,
-                      "playlist_id": "3QlWwTD13vWFH6UOTH9514"}
-        hiphopheads = {"subreddit_name": "hiphopheads",
-                       "upvote_thresh": 20,
-                       "playlist_id": "3KwOTBOoSfymm3trVqr0oJ"}
-        popheads = {"subreddit_name": "popheads",
-                    "upvote_thresh": 20,
-                    "playlist_id": "72aULoyZowHVuHH1kETADA"}
-        subreddit_settings = [indieheads, hiphopheads, popheads]
-
-        for subreddit_setting in subreddit_settings:
-            print(
-                "Getting FreshTracks from r/" +
-                subreddit_setting["subreddit_name"])
-            freshtracks = FreshTracks(subreddit_setting)
-            freshtracks.run()
-            print("\n\n")
+        subreddit_settings = SUBREDDIT_SETTINGS
+
+        # Have all indexes in place before the subreddits query the DB
+        ensure_indexes()
+
+        # All subreddits share the same API clients (and their connection
+        # pools, tokens and rate limiters)
+        rcli = RedditCli("bot1", "basic")
+        scli = SpotifyCli()
+
+        profiler = StageProfiler() \
+            if args.profile or profiling_requested() else None
+
+        freshtracks_by_name = {
+            subreddit_setting["subreddit_name"]:
+                FreshTracks(subreddit_setting, rcli, scli, profiler=profiler)
+            for subreddit_setting in subreddit_settings}
+
+        # New posts of each subreddit, fed from the combined listing
+        feeds = dict()
+        if COMBINED_LISTING:
+            feeds = {subreddit_name: Feed(freshtracks.stream_buffer_size)
+                     for subreddit_name, freshtracks
+                     in freshtracks_by_name.items()}
+
+        # Process all subreddits in parallel
+        with ThreadPoolExecutor(max_workers=len(subreddit_settings)) \
+                as executor:
+            futures = {
+                subreddit_name:
+                    executor.submit(run_subreddit, freshtracks,
+                                    feeds.get(subreddit_name))
+                for subreddit_name, freshtracks
+                in freshtracks_by_name.items()}
+
+            # One listing walk for all subreddits, while they process the
+            # posts walked so far. If it fails, each subreddit retrieves the
+            # rest of its posts itself.
+            if feeds:
+                try:
+                    retrieve_combined(freshtracks_by_name, rcli, feeds)
+                except Exception as e:
+                    print("Combined listing failed: " + str(e))
+                    logger.error("Failed to retrieve combined listing",
+                                 exc_info=e)
+
+        print("Spotify lookups shared between subreddits: " +
+              scli.resolution_cache.stats())
+
+        # Requests made outside of the subreddits' stages
+        METRICS.emit(None, dict())
+
+        # A failed subreddit doesn't stop the others
+        failed = []
+        for subreddit_name, future in futures.items():
+            e = future.exception()
+            if e:
+                print("Exception caught in r/" + subreddit_name + ": " +
+                      str(e))
+                logger.error("Failed to get FreshTracks from r/%s",
+                             subreddit_name, exc_info=e)
+                failed.append(subreddit_name)
 
     except Exception as e:
         print(e)
@@ -56,6 +187,9 @@ def main():
         logger.exception(e)
         sys.exit(1)
 
+    if failed:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,282 @@
+"""A module for measuring what each stage of a run costs.
+
+Records the requests made to Reddit, Spotify and Mongo, and the time spent
+waiting on rate limits, attributed to the (subreddit, stage) being run (see
+stages.current_stage). After each subreddit's run, its metrics are emitted
+as a JSON line and as a Prometheus textfile collector file.
+
+Mongo commands are counted with their time, but their bytes are only
+measured if the FRESHTRACKS_MONGO_BYTES environment variable is set, since
+that means encoding every command and reply a second time.
+
+NOTE: The Mongo listener only sees clients created after this module is
+imported, so it has to be imported before any model connects to Mongo.
+
+author: Soobeen Park
+file: metrics.py
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+import bson
+from pymongo import monitoring
+
+from stages import current_stage
+
+SERVICES = ["reddit", "spotify", "mongo"]
+
+# Stage of requests made outside of any stage, eg. the combined listing
+SETUP_STAGE = (None, "setup")
+
+MONGO_BYTES_ENV_VAR = "FRESHTRACKS_MONGO_BYTES"
+
+# Service of each API domain, to attribute HTTP responses to
+SERVICE_DOMAINS = {"reddit.com": "reddit", "spotify.com": "spotify"}
+
+
+def mongo_bytes_requested() -> bool:
+    """Checks whether Mongo bytes should be measured, per the environment."""
+    return os.environ.get(MONGO_BYTES_ENV_VAR, "") not in ("", "0")
+
+
+def new_counters() -> dict:
+    """Counters of a single stage, all zero."""
+    return {service: {"requests": 0, "bytes": 0, "seconds": 0.0,
+                      "rate_limit_waits": 0, "rate_limit_seconds": 0.0}
+            for service in SERVICES}
+
+
+class Metrics:
+    """Counters of the requests and rate limit waits of each stage."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Counters keyed by (subreddit name, stage name), until emitted
+        self.counters = dict()
+        # Last emitted metrics of each subreddit's stages, keyed by subreddit
+        # name then stage name, for the textfiles
+        self.last_emitted = dict()
+
+    def stage_counters(self) -> dict:
+        """Counters of the current thread's stage. Call with lock held."""
+        stage_key = current_stage.get() or SETUP_STAGE
+        if stage_key not in self.counters:
+            self.counters[stage_key] = new_counters()
+        return self.counters[stage_key]
+
+    def record_request(self, service, num_bytes, seconds):
+        """Records a request made by the current thread's stage.
+
+        Args:
+            service (str): One of SERVICES.
+            num_bytes (int): Bytes sent and received.
+            seconds (float): Time taken by the request.
+        """
+        with self.lock:
+            counters = self.stage_counters()[service]
+            counters["requests"] += 1
+            counters["bytes"] += num_bytes
+            counters["seconds"] += seconds
+
+    def record_wait(self, service, seconds):
+        """Records a rate limit wait of the current thread's stage.
+
+        Args:
+            service (str): One of SERVICES.
+            seconds (float): Time spent waiting.
+        """
+        if seconds <= 0:
+            return
+        with self.lock:
+            counters = self.stage_counters()[service]
+            counters["rate_limit_waits"] += 1
+            counters["rate_limit_seconds"] += seconds
+
+    def take(self, subreddit_name) -> dict:
+        """Takes the counters of a subreddit's stages, resetting them.
+
+        Args:
+            subreddit_name (str): The subreddit, or None for the requests
+                made outside of any subreddit's stages.
+
+        Return:
+            dict: The counters of each stage, keyed by stage name.
+        """
+        with self.lock:
+            keys = [key for key in self.counters if key[0] == subreddit_name]
+            return {key[1]: self.counters.pop(key) for key in keys}
+
+    def emit(self, subreddit_name, stage_times,
+             jsonl_path="../tmp/metrics.jsonl",
+             textfile_dir="../tmp/metrics/"):
+        """Emits the metrics of a subreddit's run, and resets them.
+
+        Appends a JSON line with the metrics to jsonl_path, and rewrites the
+        subreddit's Prometheus textfile in textfile_dir (point the node
+        exporter's textfile collector at it).
+
+        Args:
+            subreddit_name (str): The subreddit, or None for the requests
+                made outside of any subreddit's stages.
+            stage_times (dict): Wall time of each stage, in seconds.
+            jsonl_path (str): File to append the JSON line to.
+            textfile_dir (str): Directory to write the textfile in.
+        """
+        stage_counters = self.take(subreddit_name)
+        if not stage_times and not stage_counters:
+            return
+        timestamp = time.time()
+        label = subreddit_name or "all"
+
+        stages = dict()
+        for stage_name in list(stage_times) + list(stage_counters):
+            stages[stage_name] = {
+                "wall_seconds": stage_times.get(stage_name, 0.0),
+                "services": stage_counters.get(stage_name, new_counters())}
+
+        line = json.dumps({"timestamp": timestamp, "subreddit": label,
+                           "stages": stages})
+
+        with self.lock:
+            last_emitted = self.last_emitted.setdefault(label, dict())
+            last_emitted.update(stages)
+            textfile = prometheus_textfile(label, last_emitted, timestamp)
+
+            for path in (os.path.dirname(jsonl_path), textfile_dir):
+                if path and not os.path.exists(path):
+                    os.makedirs(path)
+            with open(jsonl_path, "a") as f:
+                f.write(line + "\n")
+
+            # Write to a temporary file first, so that the collector never
+            # reads a partially written file
+            textfile_path = os.path.join(textfile_dir,
+                                         "freshtracks_" + label + ".prom")
+            with open(textfile_path + ".tmp", "w") as f:
+                f.write(textfile)
+            os.replace(textfile_path + ".tmp", textfile_path)
+
+
+def prometheus_textfile(label, stages, timestamp) -> str:
+    """Formats a subreddit's stage metrics in the Prometheus text format.
+
+    Args:
+        label (str): The subreddit label.
+        stages (dict): The metrics of each stage, keyed by stage name.
+        timestamp (float): Unix time of the run.
+
+    Return:
+        str: The contents of the textfile.
+    """
+    metrics = [
+        ("stage_wall_seconds", "Wall time of the stage.", None),
+        ("requests", "Requests made by the stage.", "requests"),
+        ("request_bytes", "Bytes sent and received by the stage.", "bytes"),
+        ("request_seconds", "Time spent in requests by the stage.",
+         "seconds"),
+        ("rate_limit_waits", "Rate limit waits in the stage.",
+         "rate_limit_waits"),
+        ("rate_limit_wait_seconds", "Time spent waiting on rate limits in "
+         "the stage.", "rate_limit_seconds"),
+    ]
+
+    lines = []
+    for name, help_str, key in metrics:
+        name = "freshtracks_" + name
+        lines.append("# HELP %s %s" % (name, help_str))
+        lines.append("# TYPE %s gauge" % name)
+        for stage_name, stage in sorted(stages.items()):
+            labels = 'subreddit="%s",stage="%s"' % (label, stage_name)
+            if key is None:
+                lines.append("%s{%s} %s" % (name, labels,
+                                            stage["wall_seconds"]))
+                continue
+            for service, counters in stage["services"].items():
+                lines.append('%s{%s,service="%s"} %s'
+                             % (name, labels, service, counters[key]))
+
+    lines.append("# HELP freshtracks_last_run_timestamp_seconds Time of the "
+                 "last run.")
+    lines.append("# TYPE freshtracks_last_run_timestamp_seconds gauge")
+    lines.append('freshtracks_last_run_timestamp_seconds{subreddit="%s"} %s'
+                 % (label, timestamp))
+
+    return "\n".join(lines) + "\n"
+
+
+# Metrics shared by the whole process
+METRICS = Metrics()
+
+
+def service_of(url) -> Optional[str]:
+    """The service (see SERVICES) a URL belongs to, or None if unknown."""
+    host = urlsplit(url).hostname or ""
+    for domain, service in SERVICE_DOMAINS.items():
+        if host == domain or host.endswith("." + domain):
+            return service
+    return None
+
+
+def record_response(response, *args, **kwargs):
+    """requests response hook that records each response of its service."""
+    service = service_of(response.url)
+    if service is None:
+        return
+    body = response.request.body or b""
+    METRICS.record_request(
+        service, len(body) + len(response.content),
+        response.elapsed.total_seconds())
+
+
+def record_responses(session):
+    """Records what each request sent with session costs.
+
+    The hook is only added once per session, and attributes each response
+    to its service by URL, so that a session shared by Reddit and Spotify
+    clients (eg. by bench/replay.py) counts each request once.
+
+    Args:
+        session (requests.Session): The session to record.
+    """
+    hooks = session.hooks["response"]
+    if record_response not in hooks:
+        hooks.append(record_response)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Records every command sent to Mongo."""
+
+    def __init__(self, measure_bytes=False):
+        """Instantiates the listener.
+
+        Args:
+            measure_bytes (bool): Whether to measure the bytes of each
+                command and reply, by encoding them again.
+        """
+        self.measure_bytes = measure_bytes
+        # Bytes sent with each command in flight, keyed by request id
+        self.sent = dict()
+
+    def started(self, event):
+        if self.measure_bytes:
+            self.sent[event.request_id] = len(bson.encode(event.command))
+
+    def succeeded(self, event):
+        num_bytes = 0
+        if self.measure_bytes:
+            num_bytes = self.sent.pop(event.request_id, 0) + \
+                len(bson.encode(event.reply))
+        METRICS.record_request("mongo", num_bytes,
+                               event.duration_micros / 1e6)
+
+    def failed(self, event):
+        METRICS.record_request("mongo", self.sent.pop(event.request_id, 0),
+                               event.duration_micros / 1e6)
+
+
+monitoring.register(MongoCommandListener(mongo_bytes_requested()))
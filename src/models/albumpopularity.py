@@ -0,0 +1,16 @@
+from pymodm import connect, MongoModel, fields
+
+connect("mongodb://localhost:27017/FreshTracks", alias="FreshTracks")
+
+
+class AlbumPopularity(MongoModel):
+    spotify_album_uri = fields.CharField(required=True, primary_key=True)
+    track = fields.CharField()
+    track_num = fields.IntegerField()
+    spotify_track_uri = fields.CharField()
+    popularity = fields.IntegerField()
+    checked_at = fields.DateTimeField()
+
+    class Meta:
+        connection_alias = "FreshTracks"
+        collection_name = "albumpopularity"
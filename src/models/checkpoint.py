@@ -0,0 +1,14 @@
+from pymodm import connect, MongoModel, fields
+
+connect("mongodb://localhost:27017/FreshTracks", alias="FreshTracks")
+
+
+class Checkpoint(MongoModel):
+    # Newest submission seen in each subreddit, whether or not it was saved
+    subreddit = fields.CharField(required=True, primary_key=True)
+    fullname = fields.CharField()
+    created_utc = fields.DateTimeField()
+
+    class Meta:
+        connection_alias = "FreshTracks"
+        collection_name = "checkpoint"
@@ -0,0 +1,13 @@
+from pymodm import connect, MongoModel, fields
+
+connect("mongodb://localhost:27017/FreshTracks", alias="FreshTracks")
+
+
+class PlaylistSnapshot(MongoModel):
+    # Spotify's version of each playlist as of FreshTracks' last write to it
+    playlist_id = fields.CharField(required=True, primary_key=True)
+    snapshot_id = fields.CharField()
+
+    class Meta:
+        connection_alias = "FreshTracks"
+        collection_name = "playlistsnapshot"
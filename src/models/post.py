@@ -19,8 +19,10 @@ class Post(MongoModel):
     created_utc = fields.DateTimeField()
     upvotes = fields.IntegerField()
     exists_in_playlist = fields.BooleanField(default=False)
-    parsed_artist = fields.CharField()
-    parsed_title = fields.CharField()
+    # None for posts resolved from their Spotify link alone, whose title
+    # couldn't be parsed
+    parsed_artist = fields.CharField(blank=True)
+    parsed_title = fields.CharField(blank=True)
 
     class Meta:
         connection_alias = "FreshTracks"
@@ -31,5 +33,19 @@ class Post(MongoModel):
             IndexModel(
                 keys=[("spotify_album_uri", pymongo.ASCENDING),
                       ("subreddit", pymongo.ASCENDING)],
-                unique=True)
+                unique=True),
+            # Most recent post of a subreddit, and its posts of the past week
+            IndexModel(
+                keys=[("subreddit", pymongo.ASCENDING),
+                      ("created_utc", pymongo.DESCENDING)]),
+            # Posts of the past week above the upvote threshold, sorted by
+            # upvotes (equality, then sort, then range field)
+            IndexModel(
+                keys=[("subreddit", pymongo.ASCENDING),
+                      ("upvotes", pymongo.DESCENDING),
+                      ("created_utc", pymongo.DESCENDING)]),
+            # Posts in a subreddit's playlist, a small fraction of all posts
+            IndexModel(
+                keys=[("subreddit", pymongo.ASCENDING)],
+                partialFilterExpression={"exists_in_playlist": True})
         ]
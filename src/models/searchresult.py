@@ -0,0 +1,23 @@
+from pymodm import connect, MongoModel, fields
+import pymongo
+from pymongo import IndexModel
+
+connect("mongodb://localhost:27017/FreshTracks", alias="FreshTracks")
+
+
+class SearchResult(MongoModel):
+    key = fields.CharField(required=True, primary_key=True)
+    response = fields.DictField(blank=True)
+    created = fields.DateTimeField()
+    expires_at = fields.DateTimeField()
+
+    class Meta:
+        connection_alias = "FreshTracks"
+        collection_name = "searchresult"
+        indexes = [
+            # Let MongoDB drop cached results once they expire
+            IndexModel(keys=[("expires_at", pymongo.ASCENDING)],
+                       expireAfterSeconds=0),
+            # Used to evict the oldest results once the cache is full
+            IndexModel(keys=[("created", pymongo.ASCENDING)])
+        ]
@@ -0,0 +1,205 @@
+"""A module for streaming items through the stages of a run.
+
+Contains the Pipeline that runs each stage in its own thread, connected to
+the next stage by a bounded queue, so that a stage can start on the first
+items while the stages before it are still producing the rest.
+
+author: Soobeen Park
+file: pipeline.py
+"""
+
+import itertools
+import queue
+import threading
+from typing import Iterator, List
+
+# Put into a queue after the last item of a stage
+_DONE = object()
+
+
+def batched(items, size) -> Iterator[List]:
+    """Lazily groups items into consecutive lists of at most size items.
+
+    Args:
+        items (Iterable): The items to group.
+        size (int): Maximum number of items per list.
+
+    Yields:
+        list: The next group of items.
+    """
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Pipeline:
+    """Streams items through a chain of generator stages.
+
+    Each stage is a function that takes an iterator of the items produced by
+    the stage before it, and yields its own items. The stages run
+    concurrently, each in its own thread, with at most buffer_size items
+    waiting between two stages. A stage that gets ahead therefore blocks
+    until the next stage catches up, which bounds the items in memory.
+    """
+
+    def __init__(self, buffer_size=100, poll_interval=0.1):
+        """Instantiates an empty pipeline.
+
+        Args:
+            buffer_size (int): Max number of items waiting between stages.
+            poll_interval (float): How often (in seconds) blocked stages
+                check whether the pipeline was stopped by an error.
+        """
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self.stages = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.error = None
+
+    def add_stage(self, fn):
+        """Appends a stage to the pipeline.
+
+        Args:
+            fn (function): Takes an iterator of input items, and returns an
+                iterator (usually a generator) of output items.
+        """
+        self.stages.append(fn)
+
+    def put(self, q, item) -> bool:
+        """Puts item in q, unless the pipeline is stopped first."""
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(self, q) -> Iterator:
+        """Yields the items put in q, until the stage before is done."""
+        while not self.stopped.is_set():
+            try:
+                item = q.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def run_stage(self, fn, inputs, output, results):
+        """Runs a stage, putting its items in output (or results, if last)."""
+        items = None
+        try:
+            items = fn(inputs)
+            for item in items:
+                if output is None:
+                    results.append(item)
+                elif not self.put(output, item):
+                    break
+        except Exception as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+            self.stopped.set()
+        finally:
+            # Close the stage here, so that it is cleaned up in its own thread
+            if hasattr(items, "close"):
+                items.close()
+            if output is not None:
+                self.put(output, _DONE)
+
+    def run(self, items=()) -> List:
+        """Streams items through all stages, and waits for them to finish.
+
+        Args:
+            items (Iterable): The input items of the first stage.
+
+        Return:
+            list: The items yielded by the last stage.
+
+        Raises:
+            Exception: The first exception raised by any stage, once all
+                stages are stopped.
+        """
+        results = []
+        threads = []
+        inputs = iter(items)
+        for i, fn in enumerate(self.stages):
+            output = queue.Queue(maxsize=self.buffer_size) \
+                if i < len(self.stages) - 1 else None
+            threads.append(threading.Thread(
+                target=self.run_stage, args=(fn, inputs, output, results)))
+            if output is not None:
+                inputs = self.drain(output)
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+        return results
+
+
+class Feed:
+    """Bounded queue that feeds items from one thread into another's run.
+
+    The producer put()s items and then finish()es the feed, while the
+    consumer iterates over it, and close()s it if it stops early. As with the
+    queues between pipeline stages, a producer that gets ahead blocks until
+    the consumer catches up.
+    """
+
+    def __init__(self, buffer_size=100, poll_interval=0.1):
+        """Instantiates an empty feed.
+
+        Args:
+            buffer_size (int): Max number of items waiting in the feed.
+            poll_interval (float): How often (in seconds) a blocked producer
+                checks whether the consumer stopped.
+        """
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.poll_interval = poll_interval
+        self.closed = threading.Event()
+        self.finished = False
+        # Whether the producer put all items it was meant to
+        self.complete = None
+
+    def put(self, item) -> bool:
+        """Puts item in the feed, unless the consumer stopped first."""
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def finish(self, complete=True):
+        """Marks the end of the items.
+
+        Args:
+            complete (bool): False if the producer stopped before putting
+                all items it was meant to, eg. on an error.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.complete = complete
+        self.put(_DONE)
+
+    def close(self):
+        """Tells the producer that the consumer stopped taking items."""
+        self.closed.set()
+
+    def __iter__(self) -> Iterator:
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                return
+            yield item
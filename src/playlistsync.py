@@ -0,0 +1,495 @@
+"""A module for reconciling a Spotify playlist with its target order.
+
+Contains the planner used to work out a near-minimal set of Spotify playlist
+mutations that turn the current playlist order into the target order, and the
+in-memory model of the playlist that the mutations are mirrored in.
+
+author: Soobeen Park
+file: playlistsync.py
+"""
+
+import itertools
+import math
+from typing import List
+
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+
+from chunking import chunked
+from models.post import Post
+from models.playlisttrack import PlaylistTrack
+
+# Spotify accepts at most 100 items per playlist add/replace/remove request
+SPOTIFY_ITEMS_PER_REQUEST = 100
+
+
+def longest_increasing_subsequence(seq) -> set:
+    """Find the indices of a longest strictly increasing subsequence of seq.
+
+    Uses patience sorting, which runs in O(n log n).
+
+    Args:
+        seq (list): A list of mutually comparable values.
+
+    Return:
+        set: The indices into seq of the elements in the subsequence.
+    """
+    # tails[k] is the index of the smallest tail of an increasing
+    # subsequence of length k + 1 found so far
+    tails = []
+    # prev[i] is the index of the element before seq[i] in its subsequence
+    prev = [None] * len(seq)
+
+    for i, value in enumerate(seq):
+        # Binary search for the first tail that is >= value
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if seq[tails[mid]] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo > 0:
+            prev[i] = tails[lo - 1]
+        if lo == len(tails):
+            tails.append(i)
+        else:
+            tails[lo] = i
+
+    # Walk back from the tail of the longest subsequence
+    indices = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        indices.add(i)
+        i = prev[i]
+
+    return indices
+
+
+class PlaylistPlan:
+    """The Spotify mutations needed to reorder a playlist into target order.
+
+    Attributes:
+        target (list): The keys of the playlist in their target order.
+        moves (list): (key, range_start, insert_before) tuples, to be applied
+            in order with playlist_reorder_items().
+        inserts (list): (position, [keys]) tuples of adjacent new items, to be
+            applied in order with playlist_add_items().
+        rewrite (bool): True if rewriting the whole playlist with
+            playlist_replace_items() takes fewer requests than the moves and
+            inserts. In that case moves and inserts should be ignored.
+    """
+
+    def __init__(self, target, moves, inserts, rewrite):
+        self.target = target
+        self.moves = moves
+        self.inserts = inserts
+        self.rewrite = rewrite
+
+    def incremental_calls(self) -> int:
+        """Number of requests needed to apply the moves and inserts."""
+        return len(self.moves) + len(self.inserts)
+
+    def rewrite_calls(self) -> int:
+        """Number of requests needed to rewrite the whole playlist."""
+        # A replace of the first chunk, then one add for each remaining chunk
+        return max(1, math.ceil(len(self.target) / SPOTIFY_ITEMS_PER_REQUEST))
+
+
+def plan_playlist(current, target, allow_rewrite=False) -> PlaylistPlan:
+    """Plans the mutations that turn current playlist order into target order.
+
+    The items of current that keep their relative order in target (a longest
+    increasing subsequence of their target ranks) are left in place, and only
+    the remaining items are moved. Each of those is moved directly behind its
+    predecessor in target order. Items of target that are not yet in the
+    playlist are inserted afterwards, in ascending target position, with
+    adjacent items coalesced into one request.
+
+    Items of current that are missing from target are kept, and are ordered
+    at the end of the playlist in their current relative order.
+
+    Args:
+        current (list): Keys of the items currently in the playlist, in order.
+        target (list): Keys of the items in the order they should end up in.
+        allow_rewrite (bool): Whether the plan may rewrite the whole playlist
+            when that takes fewer requests. Note that a rewrite resets the
+            "added date" of every track in the playlist.
+
+    Return:
+        PlaylistPlan: The planned mutations.
+    """
+    target_set = set(target)
+    target = list(target) + [key for key in current if key not in target_set]
+    rank = {key: i for i, key in enumerate(target)}
+    current_set = set(current)
+
+    # Items whose relative order is already correct stay where they are
+    keep = longest_increasing_subsequence([rank[key] for key in current])
+    stay = {current[i] for i in keep}
+
+    # Simulate the moves on a copy of the playlist to get each move's indices
+    moves = []
+    playlist = list(current)
+    prev_key = None
+    for key in target:
+        if key not in current_set:
+            continue
+
+        if key not in stay:
+            range_start = playlist.index(key)
+            insert_before = 0 if prev_key is None \
+                else playlist.index(prev_key) + 1
+
+            # Skip moves that have become no-ops from earlier moves
+            if range_start != insert_before:
+                moves.append((key, range_start, insert_before))
+                playlist.pop(range_start)
+                if range_start < insert_before:
+                    insert_before -= 1
+                playlist.insert(insert_before, key)
+
+        prev_key = key
+
+    # Inserting in ascending target position means that everything before
+    # each insert is already in its final place
+    inserts = []
+    for pos, key in enumerate(target):
+        if key in current_set:
+            continue
+        if inserts:
+            last_pos, last_keys = inserts[-1]
+            if last_pos + len(last_keys) == pos and \
+                    len(last_keys) < SPOTIFY_ITEMS_PER_REQUEST:
+                last_keys.append(key)
+                continue
+        inserts.append((pos, [key]))
+
+    plan = PlaylistPlan(target, moves, inserts, rewrite=False)
+    if allow_rewrite and plan.rewrite_calls() < plan.incremental_calls():
+        plan.rewrite = True
+
+    return plan
+
+
+def remove_positions(spot, playlist_id, positions, snapshot_id=None):
+    """Removes the items at positions from a playlist, whatever they are.
+
+    spotipy only removes items by uri, which items without a track (eg.
+    tracks that were taken off Spotify) don't have. The endpoint also takes
+    bare positions, checked against the snapshot_id.
+
+    Args:
+        spot (spotipy.Spotify): The Spotify client.
+        playlist_id (str): Spotify playlist ID.
+        positions (list): Positions of the items to remove.
+        snapshot_id (str): The playlist version the positions are of.
+
+    Return:
+        dict: The response, with the playlist's new snapshot_id.
+    """
+    payload = {"positions": positions}
+    if snapshot_id:
+        payload["snapshot_id"] = snapshot_id
+    return spot._delete("playlists/%s/tracks"
+                        % spot._get_id("playlist", playlist_id),
+                        payload=payload)
+
+
+class OrderedPlaylist:
+    """In-memory model of the tracks in a playlist, in order.
+
+    The model is loaded once per run and mutated in memory as tracks are
+    removed, inserted, moved and swapped. All changes are then written back
+    by flush(), with one bulk write to each of the PlaylistTrack and Post
+    collections.
+    """
+
+    def __init__(self, playlisttracks):
+        """Instantiates the model from the playlist's PlaylistTracks.
+
+        Args:
+            playlisttracks (Iterable[PlaylistTrack]): The tracks in the
+                playlist, in playlist position order.
+        """
+        self.posts = []
+        # Positions as of the last flush, to diff against. Taken as stored,
+        # so that any gaps in them are written over on the next flush.
+        self.flushed_positions = dict()
+        for playlisttrack in playlisttracks:
+            self.posts.append(playlisttrack.post)
+            self.flushed_positions[playlisttrack.post.reddit_post_id] = \
+                playlisttrack.playlist_position
+        # Every post that was in the model since the last flush
+        self.known_posts = {p.reddit_post_id: p for p in self.posts}
+        # Posts with changed fields (other than exists_in_playlist)
+        self.changed_posts = dict()
+
+    def __len__(self):
+        return len(self.posts)
+
+    def __iter__(self):
+        return iter(list(self.posts))
+
+    def positions(self) -> dict:
+        """Maps the reddit_post_id of each post to its playlist position."""
+        return {p.reddit_post_id: i for i, p in enumerate(self.posts)}
+
+    def ids(self) -> List[str]:
+        """The reddit_post_id of each post in the playlist, in order."""
+        return [p.reddit_post_id for p in self.posts]
+
+    def remove(self, pos):
+        """Removes the post at pos from the playlist.
+
+        Return:
+            Post: The removed post.
+        """
+        return self.posts.pop(pos)
+
+    def insert(self, pos, posts):
+        """Inserts posts into the playlist, the first one at pos."""
+        for post in posts:
+            self.known_posts[post.reddit_post_id] = post
+        self.posts[pos:pos] = posts
+
+    def move(self, range_start, insert_before):
+        """Moves the post at range_start to before insert_before.
+
+        Mirrors Spotify's playlist_reorder_items(), ie. insert_before is the
+        position before the post is taken out.
+        """
+        post = self.posts.pop(range_start)
+        if range_start < insert_before:
+            insert_before -= 1
+        self.posts.insert(insert_before, post)
+
+    def replace_all(self, posts):
+        """Replaces the whole playlist with posts, in order."""
+        self.posts = []
+        self.insert(0, list(posts))
+
+    def mark_changed(self, post):
+        """Marks a post in the playlist as changed, to be saved on flush."""
+        self.changed_posts[post.reddit_post_id] = post
+
+    def flush(self) -> int:
+        """Writes all changes since the last flush back to the database.
+
+        Return:
+            int: The number of documents written.
+        """
+        positions = self.positions()
+
+        playlisttrack_ops = []
+        post_ops = []
+        for reddit_post_id, pos in positions.items():
+            flushed_pos = self.flushed_positions.get(reddit_post_id)
+            if flushed_pos is None:
+                post = self.known_posts[reddit_post_id]
+                post.exists_in_playlist = True
+                self.changed_posts[reddit_post_id] = post
+                # Upsert, in case a stale PlaylistTrack was left behind
+                playlisttrack_ops.append(ReplaceOne(
+                    {"_id": reddit_post_id},
+                    PlaylistTrack(post=post, playlist_position=pos).to_son(),
+                    upsert=True))
+            elif flushed_pos != pos:
+                playlisttrack_ops.append(UpdateOne(
+                    {"_id": reddit_post_id},
+                    {"$set": {"playlist_position": pos}}))
+
+        for reddit_post_id in self.flushed_positions:
+            if reddit_post_id not in positions:
+                post = self.known_posts[reddit_post_id]
+                post.exists_in_playlist = False
+                self.changed_posts[reddit_post_id] = post
+                playlisttrack_ops.append(DeleteOne({"_id": reddit_post_id}))
+
+        for reddit_post_id, post in self.changed_posts.items():
+            post_ops.append(ReplaceOne({"_id": reddit_post_id},
+                                       post.to_son()))
+
+        if playlisttrack_ops:
+            PlaylistTrack._mongometa.collection.bulk_write(
+                playlisttrack_ops, ordered=False)
+        if post_ops:
+            Post._mongometa.collection.bulk_write(post_ops, ordered=False)
+
+        self.flushed_positions = positions
+        self.known_posts = {p.reddit_post_id: p for p in self.posts}
+        self.changed_posts = dict()
+
+        return len(playlisttrack_ops) + len(post_ops)
+
+
+class PlaylistMutations:
+    """Queue of the Spotify mutations of a playlist in a run.
+
+    Mutations are queued in the order they apply, each with positions
+    relative to the playlist as left by the mutations before it (ie. as
+    mirrored in OrderedPlaylist). They are only sent by apply(), in as few
+    requests as possible:
+        - Removals queued after other removals and inserts (eg. the swaps of
+          replace_album_most_popular_track) are sent before those inserts,
+          in one request per 100 positions.
+        - Inserts of adjacent positions are sent in one request (up to 100
+          items).
+        - Removal chunks are sent from the end of the playlist backwards, so
+          that no chunk shifts the positions of the next.
+    The snapshot_id returned by each request is passed on to the next
+    request that takes one, so that Spotify checks its positions against the
+    playlist version they were worked out for.
+    """
+
+    def __init__(self, snapshot_id=None):
+        """Instantiates an empty queue.
+
+        Args:
+            snapshot_id (str): The playlist's current snapshot_id, if known.
+        """
+        self.snapshot_id = snapshot_id
+        # Queued ("group", removals, inserts), ("move", range_start,
+        # insert_before) and ("replace", uris) mutations. A group removes the
+        # items of removals ({position: uri}) at once, then applies inserts
+        # ([position, [uris]]) in order.
+        self.queue = []
+
+    def __len__(self):
+        return len(self.queue)
+
+    def last_group(self):
+        """The last queued group, after queueing a new one if needed."""
+        if not self.queue or self.queue[-1][0] != "group":
+            self.queue.append(("group", dict(), []))
+        return self.queue[-1]
+
+    def remove(self, items):
+        """Queues the removal of items from the playlist.
+
+        Args:
+            items (list): (uri, position) tuples of the items to remove, with
+                positions relative to the playlist before the removal. The
+                uri is None for items without a track, which are removed by
+                position alone.
+        """
+        _, removals, inserts = self.last_group()
+
+        # Map the positions back to before the group's inserts
+        positions = {pos: uri for uri, pos in items}
+        for pos, count in [(pos, len(uris)) for pos, uris in inserts][::-1]:
+            if any(pos <= p < pos + count for p in positions):
+                # Removes an item that the group inserts, which can't be
+                # done before the insert
+                self.queue.append(("group",
+                                   {pos: uri for uri, pos in items}, []))
+                return
+            positions = {p - count if p >= pos + count else p: uri
+                         for p, uri in positions.items()}
+        before_inserts = positions
+
+        # The inserts now happen with the items already removed
+        for insert in inserts:
+            pos, uris = insert
+            insert[0] = pos - sum(p < pos for p in positions)
+            positions = {p + len(uris) if p >= pos else p: uri
+                         for p, uri in positions.items()}
+
+        # Map the positions back to before the group's removals
+        removed = sorted(removals)
+        for p, uri in sorted(before_inserts.items()):
+            for r in removed:
+                if r <= p:
+                    p += 1
+            removals[p] = uri
+
+    def insert(self, pos, uris):
+        """Queues the insert of uris into the playlist, the first one at pos.
+        """
+        _, _, inserts = self.last_group()
+        if inserts:
+            last_pos, last_uris = inserts[-1]
+            if last_pos + len(last_uris) == pos and \
+                    len(last_uris) + len(uris) <= SPOTIFY_ITEMS_PER_REQUEST:
+                last_uris.extend(uris)
+                return
+        for chunk in chunked(list(uris), SPOTIFY_ITEMS_PER_REQUEST):
+            inserts.append([pos, chunk])
+            pos += len(chunk)
+
+    def move(self, range_start, insert_before):
+        """Queues a move of the item at range_start to before insert_before.
+
+        Positions are as in Spotify's playlist_reorder_items().
+        """
+        self.queue.append(("move", range_start, insert_before))
+
+    def replace_all(self, uris):
+        """Queues a rewrite of the whole playlist with uris, in order."""
+        # Makes every mutation queued so far moot
+        self.queue = [("replace", list(uris))]
+
+    def apply(self, spot, playlist_id) -> int:
+        """Sends all queued mutations to Spotify, and empties the queue.
+
+        Args:
+            spot (spotipy.Spotify): The Spotify client.
+            playlist_id (str): Spotify playlist ID.
+
+        Return:
+            int: The number of requests sent.
+        """
+        num_requests = 0
+
+        def sent(result):
+            nonlocal num_requests
+            num_requests += 1
+            if result and result.get("snapshot_id"):
+                self.snapshot_id = result["snapshot_id"]
+
+        for mutation in self.queue:
+            if mutation[0] == "group":
+                _, removals, inserts = mutation
+                positions = sorted(removals, reverse=True)
+                # Items without a uri are removed by position alone, in
+                # requests of their own, still from the end backwards
+                for has_uri, run in itertools.groupby(
+                        positions, key=lambda pos: removals[pos] is not None):
+                    for chunk in chunked(list(run),
+                                         SPOTIFY_ITEMS_PER_REQUEST):
+                        if not has_uri:
+                            sent(remove_positions(spot, playlist_id, chunk,
+                                                  self.snapshot_id))
+                            continue
+                        items = dict()
+                        for pos in chunk:
+                            items.setdefault(removals[pos], []).append(pos)
+                        sent(spot
+                             .playlist_remove_specific_occurrences_of_items(
+                                 playlist_id,
+                                 [{"uri": uri, "positions": positions}
+                                  for uri, positions in items.items()],
+                                 snapshot_id=self.snapshot_id))
+                for pos, uris in inserts:
+                    sent(spot.playlist_add_items(playlist_id, uris,
+                                                 position=pos))
+
+            elif mutation[0] == "move":
+                _, range_start, insert_before = mutation
+                sent(spot.playlist_reorder_items(
+                    playlist_id, range_start=range_start,
+                    insert_before=insert_before,
+                    snapshot_id=self.snapshot_id))
+
+            else:
+                _, uris = mutation
+                chunks = chunked(uris, SPOTIFY_ITEMS_PER_REQUEST)
+                for i, chunk in enumerate(chunks):
+                    if i == 0:
+                        sent(spot.playlist_replace_items(playlist_id, chunk))
+                    else:
+                        sent(spot.playlist_add_items(playlist_id, chunk))
+                if not uris:
+                    sent(spot.playlist_replace_items(playlist_id, []))
+
+        self.queue = []
+        return num_requests
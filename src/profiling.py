@@ -0,0 +1,136 @@
+"""A module for profiling the stages of a run.
+
+Profiling is opt-in, with main.py --profile or by setting the
+FRESHTRACKS_PROFILE environment variable. Each stage of each subreddit is
+run under its own cProfile profiler, one per thread that works on the stage
+(see FreshTracks.in_stage()), and the profiles are merged and written out
+with an allocation snapshot from tracemalloc after the subreddit's run, eg.
+
+    ../tmp/profiles/20201015-130000/indieheads.parse.prof
+    ../tmp/profiles/20201015-130000/indieheads.tracemalloc
+
+Open a profile with `python -m pstats FILE` (or snakeviz), and a snapshot
+with tracemalloc.Snapshot.load().
+
+NOTE: Python 3.12+ allows only one active profiler at a time, so a stage
+that runs while another is profiled goes unprofiled. The stages that were
+(partly) skipped are reported, so that their profiles aren't trusted.
+
+author: Soobeen Park
+file: profiling.py
+"""
+
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import os
+import pstats
+import threading
+import tracemalloc
+
+PROFILE_ENV_VAR = "FRESHTRACKS_PROFILE"
+
+
+def profiling_requested() -> bool:
+    """Checks whether profiling was asked for in the environment."""
+    return os.environ.get(PROFILE_ENV_VAR, "") not in ("", "0")
+
+
+class StageProfiler:
+    """Profiles the stages of each subreddit's run."""
+
+    def __init__(self, output_dir="../tmp/profiles/", traceback_frames=10):
+        """Instantiates the profiler, and starts tracing allocations.
+
+        Args:
+            output_dir (str): Directory to write a subdirectory of profiles
+                to, named after the current time.
+            traceback_frames (int): Frames stored per traced allocation.
+        """
+        self.output_dir = os.path.join(
+            output_dir, datetime.now().strftime("%Y%m%d-%H%M%S"))
+        self.lock = threading.Lock()
+        # Profiler of each stage in each thread, keyed by (subreddit name,
+        # stage name, thread id)
+        self.profiles = dict()
+        # (subreddit name, stage name) of the stages that went unprofiled
+        # at least once
+        self.skipped = set()
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(traceback_frames)
+
+    @contextmanager
+    def profile(self, subreddit_name, stage_name):
+        """Profiles the body as (part of) a stage of a subreddit's run.
+
+        Only the calling thread is profiled, so work that the stage hands
+        to other threads has to be profiled in those threads too. A stage
+        entered more than once (eg. once per batch, or from several threads)
+        accumulates into the same profile.
+
+        Args:
+            subreddit_name (str): The subreddit being run.
+            stage_name (str): The name of the stage.
+        """
+        key = (subreddit_name, stage_name, threading.get_ident())
+        with self.lock:
+            profile = self.profiles.setdefault(key, cProfile.Profile())
+        try:
+            profile.enable()
+        except ValueError:
+            # Newer Pythons allow only one active profiler at a time
+            with self.lock:
+                first_skip = (subreddit_name, stage_name) not in self.skipped
+                self.skipped.add((subreddit_name, stage_name))
+            if first_skip:
+                print("r/%s\tNot profiling %s, another profiler is active"
+                      % (subreddit_name, stage_name))
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def dump(self, subreddit_name):
+        """Writes out the profiles of a subreddit's stages.
+
+        The profiles of each stage's threads are merged into one. Also
+        writes a tracemalloc snapshot of the allocations still alive after
+        the run.
+
+        Args:
+            subreddit_name (str): The subreddit whose run is done.
+        """
+        with self.lock:
+            keys = [key for key in self.profiles if key[0] == subreddit_name]
+            profiles = dict()
+            for key in keys:
+                profiles.setdefault(key[1], []).append(
+                    self.profiles.pop(key))
+            skipped = sorted(stage_name for name, stage_name in self.skipped
+                             if name == subreddit_name)
+            self.skipped -= {(subreddit_name, stage_name)
+                             for stage_name in skipped}
+
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir, exist_ok=True)
+        for stage_name, stage_profiles in profiles.items():
+            for profile in stage_profiles:
+                profile.create_stats()
+            # Profiles of threads that were never profiled are empty
+            stage_profiles = [p for p in stage_profiles if p.stats]
+            if not stage_profiles:
+                continue
+            stats = pstats.Stats(*stage_profiles)
+            stats.dump_stats(os.path.join(
+                self.output_dir, subreddit_name + "." + stage_name + ".prof"))
+
+        tracemalloc.take_snapshot().dump(os.path.join(
+            self.output_dir, subreddit_name + ".tracemalloc"))
+        print("r/" + subreddit_name + "\tWrote profiles to " +
+              self.output_dir)
+        if skipped:
+            print("r/" + subreddit_name + "\tIncomplete profiles (another "
+                  "profiler was active): " + ", ".join(skipped))
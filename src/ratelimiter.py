@@ -0,0 +1,134 @@
+"""A module for rate limiting API requests.
+
+Contains a thread-safe token bucket, shared by everything that makes requests
+to the same API so that together they stay inside its quota.
+
+author: Soobeen Park
+file: ratelimiter.py
+"""
+
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe, adaptive token bucket rate limiter.
+
+    Tokens refill continuously at rate per second, up to capacity. Each request
+    takes one token, so bursts of up to capacity requests go through at once,
+    while the sustained request rate is held to rate per second.
+
+    When the API still throttles us, throttled() pauses every thread for the
+    Retry-After period (or an exponential backoff) plus jitter, and halves the
+    rate. Each successful request then raises the rate back towards max_rate.
+    """
+
+    def __init__(self, rate, capacity, min_rate=0.5, backoff_base=1.0,
+                 backoff_max=60.0):
+        """Instantiates a full token bucket.
+
+        Args:
+            rate (float): Tokens added per second, at most.
+            capacity (int): Maximum number of tokens in the bucket.
+            min_rate (float): The rate is never lowered below this.
+            backoff_base (float): Seconds to back off after the first throttled
+                request without a Retry-After, doubling for each retry.
+            backoff_max (float): Maximum seconds to back off at once.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = capacity
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        # Nobody may take a token before this time, while backing off
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+        # Stats
+        self.throttle_waits = 0     # Requests that had to wait for a token
+        self.throttled_count = 0    # Requests the API throttled
+        self.time_slept = 0.0       # Total seconds slept by all threads
+
+    def refill(self):
+        """Adds the tokens accumulated since the last refill.
+
+        Must be called with lock held.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def sleep(self, seconds):
+        """Sleeps and records the time slept."""
+        time.sleep(seconds)
+        with self.lock:
+            self.time_slept += seconds
+
+    def acquire(self) -> float:
+        """Takes a token, blocking until one is available.
+
+        Return:
+            float: The number of seconds spent waiting for the token.
+        """
+        with self.lock:
+            self.refill()
+            # Take the token now, even if it puts the bucket in debt, so that
+            # waiting threads queue up in order instead of racing each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            wait = max(wait, self.paused_until - time.monotonic())
+            if wait > 0:
+                self.throttle_waits += 1
+
+        if wait > 0:
+            self.sleep(wait)
+        return max(wait, 0)
+
+    def succeeded(self):
+        """Records a request that wasn't throttled, raising the rate a bit."""
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def throttled(self, retry_after, attempt) -> float:
+        """Records a throttled request and backs off before it is retried.
+
+        Args:
+            retry_after (float): Seconds the API asked us to wait, or None if
+                it didn't say.
+            attempt (int): How many times the request was already retried.
+
+        Return:
+            float: The number of seconds spent backing off.
+        """
+        if retry_after is None:
+            delay = self.backoff_base * 2 ** attempt
+        else:
+            delay = retry_after
+        delay = min(delay, self.backoff_max)
+        # Jitter keeps the waiting threads from all retrying at once
+        delay += random.uniform(0, min(1.0, delay / 4) + 0.1)
+
+        with self.lock:
+            self.throttled_count += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + delay)
+            wait = self.paused_until - time.monotonic()
+
+        if wait > 0:
+            self.sleep(wait)
+        return max(wait, 0)
+
+    def stats(self) -> dict:
+        """Snapshot of the stats so far."""
+        with self.lock:
+            return {"throttle_waits": self.throttle_waits,
+                    "throttled": self.throttled_count,
+                    "time_slept": self.time_slept}
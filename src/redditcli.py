@@ -8,45 +8,111 @@ file: redditcli.py
 """
 
 from datetime import datetime, timezone
-from typing import List
+from typing import Dict, Iterator, Optional, Tuple
+import math
+import threading
+import time
 import praw
+import prawcore
+
+from metrics import METRICS, record_responses
+
+
+class MeasuredRequestor(prawcore.Requestor):
+    """PRAW requestor that records what each Reddit request costs.
+
+    Besides recording each response (see metrics.record_responses()), it
+    records the time PRAW's rate limiter held back each API request. The
+    rate limiter sleeps until the time the x-ratelimit headers of the last
+    response allow the next request, so the same headers are read here, and
+    the part of the time since that response up until then is counted as
+    the wait.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        record_responses(self._http)
+        self.lock = threading.Lock()
+        self.last_response_at = None
+        self.next_request_at = None
+
+    def request(self, method, url, *args, **kwargs):
+        # Token requests aren't rate limited
+        limited = url.startswith(self.oauth_url)
+        if limited:
+            now = time.time()
+            with self.lock:
+                if self.next_request_at is not None:
+                    METRICS.record_wait(
+                        "reddit", min(now, self.next_request_at) -
+                        self.last_response_at)
+
+        response = super().request(method, url, *args, **kwargs)
+
+        headers = response.headers
+        if limited and "x-ratelimit-remaining" in headers:
+            # As prawcore.rate_limit.RateLimiter.update() does
+            now = time.time()
+            seconds_to_reset = int(headers["x-ratelimit-reset"])
+            remaining = float(headers["x-ratelimit-remaining"])
+            reset_at = now + seconds_to_reset
+            if remaining > 0:
+                reset_at = min(reset_at, now + max(
+                    min((seconds_to_reset - remaining) / 2, 10), 0))
+            with self.lock:
+                self.last_response_at = now
+                self.next_request_at = reset_at
+
+        return response
 
 
 class RedditCli:
     """General class to help with interacting with Reddit API."""
 
-    def __init__(self, botname, config_interp):
+    def __init__(self, botname, config_interp, session=None, **kwargs):
         """Instantiated Reddit API client.
 
         Args:
             botname (str): Name of bot in praw.ini file.
             config_interp (str): Setting to pass PRAW initializer.
+            session (requests.Session): Session to send requests with. PRAW
+                creates its own if not given.
+            kwargs: Additional settings to pass PRAW initializer.
         """
-        self.reddit = praw.Reddit(botname, config_interpolation=config_interp)
+        # Record what each request costs (see metrics.py)
+        kwargs["requestor_class"] = MeasuredRequestor
+        if session is not None:
+            kwargs["requestor_kwargs"] = {"session": session}
+        self.reddit = praw.Reddit(botname, config_interpolation=config_interp,
+                                  **kwargs)
         self.limit_max = 1000   # Max amount of posts to retreive at once
+        self.page_max = 100   # Max amount of posts per listing request
+        self.info_batch_max = 100   # Max fullnames per /api/info request
+
+    def is_fresh(self, submission) -> bool:
+        """Checks whether a submission is tagged FRESH, in title or flair."""
+        link_flair_text = submission.link_flair_text
+        return "FRESH" in submission.title.upper() or \
+            (link_flair_text and "FRESH" in link_flair_text.upper())
 
-    def retrieve_fresh(self, last_accessed_time, subreddit_name) -> List:
-        """Retrieve all fresh posts in subreddit since script was last run.
+    def retrieve_since(self, last_accessed_time,
+                       subreddit_name) -> Iterator:
+        """Retrieve all posts in subreddit created after last_accessed_time.
 
-        In each of the posts, we make the assumption that the string "FRESH"
-        appears in each submission title with new music content.
+        Posts are yielded as the listing is paged through, so that they can
+        be processed before the remaining pages are retrieved.
 
         Args:
-            reddit (praw.Reddit): Initialized reddit client.
-            last_accessed_time (int): utc time of most recent reddit post in DB.
+            last_accessed_time (datetime.datetime): tzaware time to retrieve
+                posts after.
             subreddit_name (str): Name of the subreddit we are handling.
 
-        Returns:
-            list: The list of new posts since the script was last ran.
+        Yields:
+            praw.models.Submission: The new posts, newest first.
         """
-
         # Get subreddit that we want
         subreddit = self.reddit.subreddit(subreddit_name)
 
-        # Initialize list to store only [FRESH] posts we haven't seen before
-        fresh_posts = []
-
-        # Add new posts from last hour into our fresh_posts list
         for submission in subreddit.new(limit=self.limit_max):
             # Get time that submission was created
             submission_created_time = datetime.fromtimestamp(
@@ -56,10 +122,168 @@ class RedditCli:
             if submission_created_time <= last_accessed_time:
                 break
 
-            # Add the new post to our list to process
-            link_flair_text = submission.link_flair_text
-            if "FRESH" in submission.title.upper() or \
-                    (link_flair_text and "FRESH" in link_flair_text.upper()):
-                fresh_posts.append(submission)
+            yield submission
+
+    def retrieve_before(self, fullname, subreddit_name) -> Optional[Iterator]:
+        """Retrieve all posts in subreddit newer than the post fullname.
+
+        Pages towards newer posts with the listing's before parameter, so
+        that only the new posts are downloaded. Posts are yielded oldest
+        first as each page arrives, so that they can be processed before the
+        remaining pages are retrieved. At most limit_max posts are yielded;
+        the rest are left to the next run, which pages on from the last post
+        yielded.
+
+        Args:
+            fullname (str): Fullname (ie. "t3_" + id) of the newest post seen
+                so far.
+            subreddit_name (str): Name of the subreddit we are handling.
+
+        Returns:
+            Iterator: Yields the new posts (praw.models.Submission), oldest
+                first. None if the listing can't be paged from fullname, ie.
+                if that post was deleted or removed.
+        """
+        path = "r/" + subreddit_name + "/new"
+        page = self.reddit.get(path, params={"before": fullname,
+                                             "limit": self.page_max})
+
+        if not page.children:
+            # The listing is also empty when the post before which to page
+            # isn't in it anymore. Tell apart from there being no new posts.
+            newest = next(iter(self.reddit.subreddit(subreddit_name)
+                               .new(limit=1)), None)
+            if newest is not None and newest.fullname != fullname:
+                return None
+
+        return self.page_before(path, page)
+
+    def page_before(self, path, page) -> Iterator:
+        """Yields the posts of page, then of the pages newer than it.
 
-        return fresh_posts
+        Args:
+            path (str): Path of the listing.
+            page (praw.models.Listing): The first page, as retrieved with the
+                listing's before parameter.
+
+        Yields:
+            praw.models.Submission: The posts, oldest first.
+        """
+        count = 0
+        while True:
+            # Each page is newest first, and newer than the pages before it
+            yield from reversed(page.children)
+            count += len(page.children)
+
+            # Only the missing cursor says the newest post was reached. Pages
+            # can come back short before that, eg. when Reddit filters out
+            # removed posts.
+            if page.before is None or not page.children or \
+                    count >= self.limit_max:
+                return
+            page = self.reddit.get(path, params={"before": page.before,
+                                                 "limit": self.page_max})
+
+    def retrieve_combined(self, cutoffs) -> Iterator[Tuple]:
+        """Retrieve new posts of many subreddits from one combined listing.
+
+        Walks the /new listing of all subreddits at once (eg.
+        r/indieheads+hiphopheads+popheads), routing each post to its
+        subreddit, until every subreddit's cutoff is reached. Posts are
+        yielded as the listing is paged through.
+
+        Args:
+            cutoffs (dict): Maps each subreddit name to a (fullname, time)
+                tuple of the newest post already seen in it. The walk stops
+                at fullname (which may be None), or else at the first post
+                created at or before the tzaware time.
+
+        Yields:
+            tuple: (subreddit name, post) for each new post, newest first.
+                The post is None once the subreddit's cutoff is reached, ie.
+                once all of its new posts were yielded. Subreddits whose
+                cutoff isn't reached within limit_max posts never get a None,
+                and have to retrieve the rest of their posts separately.
+        """
+        names = {name.lower(): name for name in cutoffs}
+        pending = set(cutoffs)
+
+        multireddit = self.reddit.subreddit("+".join(cutoffs))
+        num_seen = 0
+        for submission in multireddit.new(limit=self.limit_max):
+            num_seen += 1
+            name = names.get(submission.subreddit.display_name.lower())
+            if name not in pending:
+                continue
+
+            fullname, last_accessed_time = cutoffs[name]
+            submission_created_time = datetime.fromtimestamp(
+                submission.created_utc, tz=timezone.utc)
+
+            # If we reach a post that we've already seen, this subreddit is
+            # done
+            if submission.fullname == fullname or \
+                    submission_created_time <= last_accessed_time:
+                pending.discard(name)
+                yield name, None
+                if not pending:
+                    return
+                continue
+
+            yield name, submission
+
+        # If the listing ran out, the remaining subreddits have no more new
+        # posts either
+        if num_seen < self.limit_max:
+            for name in pending:
+                yield name, None
+
+    def stream_new(self, subreddit_names) -> Iterator:
+        """Stream the posts of many subreddits as they are submitted.
+
+        Starts with the most recent posts (up to 100), oldest first. After
+        each request, None is yielded, so that the caller can process the
+        posts so far and decide when to poll again.
+
+        Args:
+            subreddit_names (list): Names of the subreddits to stream.
+
+        Returns:
+            Iterator: Yields each new post (praw.models.Submission), and None
+                after each request.
+        """
+        multireddit = self.reddit.subreddit("+".join(subreddit_names))
+        return multireddit.stream.submissions(pause_after=-1)
+
+    def refresh_scores(self, reddit_post_ids) -> Dict[str, int]:
+        """Retrieve the current upvote count of many submissions at once.
+
+        Instead of fetching each submission separately, the submissions are
+        looked up by their fullnames (ie. "t3_" + id) through /api/info, which
+        resolves up to 100 fullnames per request.
+
+        Args:
+            reddit_post_ids (Iterable[str]): Reddit submission ids (no prefix).
+
+        Returns:
+            dict: Maps each found submission id to its current upvote count.
+                Submissions that Reddit could not resolve are left out.
+        """
+        fullnames = ["t3_" + post_id for post_id in reddit_post_ids]
+
+        scores = dict()
+        for submission in self.reddit.info(fullnames=fullnames):
+            scores[submission.id] = submission.ups
+
+        return scores
+
+    def info_request_count(self, num_items) -> int:
+        """Number of /api/info requests needed to look up num_items fullnames.
+
+        Args:
+            num_items (int): Number of fullnames to look up.
+
+        Returns:
+            int: The number of batched requests issued by refresh_scores().
+        """
+        return math.ceil(num_items / self.info_batch_max)
@@ -0,0 +1,131 @@
+"""A module for sharing Spotify lookups between subreddits.
+
+Contains the cache that sits under SpotifyCli's lookups, so that a release
+posted to several subreddits around the same time (eg. a [FRESH ALBUM] in
+r/indieheads, r/hiphopheads and r/popheads) is only looked up in Spotify
+once. Lookups of the same key that run at the same time wait on the one that
+started first, instead of making the same request again.
+
+author: Soobeen Park
+file: resolutioncache.py
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+import threading
+
+
+class ResolutionCache:
+    """In-memory cache of Spotify lookups, shared by all subreddits.
+
+    Keys are tuples that start with the kind of lookup, eg. ("search",
+    "album", artist, title) or ("most_popular", album_uri). Values are kept
+    for ttl, which is kept short so that the most popular track of an album
+    is still rechecked as often as POPULARITY_RECHECK_SCHEDULE asks.
+    """
+
+    def __init__(self, ttl=timedelta(minutes=10), max_entries=10000,
+                 clock=None):
+        """Instantiates the cache.
+
+        Args:
+            ttl (timedelta): How long to keep looked up values.
+            max_entries (int): Number of values kept before evicting.
+            clock (function): Returns the current (naive UTC) time. Defaults
+                to datetime.utcnow.
+        """
+        self.clock = clock or datetime.utcnow
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # (expires_at, value) of each key, oldest first
+        self.entries = OrderedDict()
+        # Future of each key being looked up
+        self.in_flight = dict()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def get(self, key, resolve):
+        """Looks up a single key, resolving it if it isn't cached.
+
+        Args:
+            key (tuple): The key to look up.
+            resolve (function): Takes no arguments, and returns the value of
+                key (or None if there is none).
+
+        Return:
+            The value of key, or None if there is none.
+        """
+        return self.get_many([key], lambda keys: {key: resolve()}).get(key)
+
+    def get_many(self, keys, resolve) -> dict:
+        """Looks up keys, resolving the ones that aren't cached at once.
+
+        Keys already being looked up by another thread are waited on rather
+        than resolved again.
+
+        Args:
+            keys (Iterable[tuple]): The keys to look up.
+            resolve (function): Takes a list of keys, and returns a dict of
+                their values. Keys left out have no value, which is cached
+                too.
+
+        Return:
+            dict: The value of each key that has one.
+
+        Raises:
+            Exception: Whatever resolve raised, in this thread or in the
+                thread whose lookup was waited on. Nothing is cached then.
+        """
+        keys = list(dict.fromkeys(keys))
+        values = dict()
+        waiting = dict()
+        claimed = []
+
+        now = self.clock()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self.hits += 1
+                    values[key] = entry[1]
+                elif key in self.in_flight:
+                    self.waits += 1
+                    waiting[key] = self.in_flight[key]
+                else:
+                    self.misses += 1
+                    self.in_flight[key] = Future()
+                    claimed.append(key)
+
+        # Resolve the claimed keys before waiting on others, so that two
+        # threads can't end up waiting on each other
+        if claimed:
+            try:
+                resolved = resolve(claimed)
+            except Exception as e:
+                with self.lock:
+                    for key in claimed:
+                        self.in_flight.pop(key).set_exception(e)
+                raise
+
+            expires_at = self.clock() + self.ttl
+            with self.lock:
+                for key in claimed:
+                    values[key] = resolved.get(key)
+                    self.entries[key] = (expires_at, values[key])
+                    self.entries.move_to_end(key)
+                    self.in_flight.pop(key).set_result(values[key])
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+        for key, future in waiting.items():
+            values[key] = future.result()
+
+        return {key: values[key] for key in keys if values[key] is not None}
+
+    def stats(self) -> str:
+        """Summary of the cache hits, misses and waits so far."""
+        return "%d hits, %d misses, %d waited on another lookup" % (
+            self.hits, self.misses, self.waits)
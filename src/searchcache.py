@@ -0,0 +1,249 @@
+"""A module for caching Spotify search results.
+
+Contains the cache that sits under SpotifyCli.search, so that the same
+artist/title/type combo is not searched in Spotify more than once in a while.
+
+author: Soobeen Park
+file: searchcache.py
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import json
+import os
+import re
+import threading
+import unicodedata
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+from models.searchresult import SearchResult
+
+
+def normalize(s) -> str:
+    """Normalizes an artist or title string for use in a cache key.
+
+    Strips accents, case, punctuation and redundant whitespace, so that
+    trivially different spellings of the same release share a cache entry.
+
+    Args:
+        s (str): The string to normalize.
+
+    Return:
+        str: The normalized string.
+    """
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    s = re.sub(r"[^\w\s]", " ", s.casefold())
+    return " ".join(s.split())
+
+
+class MongoSearchCacheBackend:
+    """Stores cached search results in their own Mongo collection.
+
+    Thread-safe, since Mongo does the locking for the results themselves.
+    """
+
+    def __init__(self, max_entries):
+        """Instantiates the Mongo backend.
+
+        Args:
+            max_entries (int): Number of results kept before evicting.
+        """
+        self.max_entries = max_entries
+        # How many puts to wait between checks of the collection size
+        self.evict_check_interval = 100
+        self.puts_since_check = 0
+        self.lock = threading.Lock()
+
+    def is_available(self) -> bool:
+        """Checks whether the Mongo server can be reached."""
+        try:
+            SearchResult._mongometa.collection.database.client \
+                .admin.command("ping")
+        except PyMongoError:
+            return False
+        return True
+
+    def get(self, key, now):
+        """Retrieve the unexpired response cached under key, or None."""
+        try:
+            result = SearchResult.objects.get({"_id": key})
+        except SearchResult.DoesNotExist:
+            return None
+        # The TTL index only removes expired documents about once a minute
+        if result.expires_at <= now:
+            return None
+        return result.response
+
+    def put(self, key, response, now, expires_at):
+        """Cache response under key until expires_at."""
+        SearchResult(key=key, response=response, created=now,
+                     expires_at=expires_at).save()
+
+        with self.lock:
+            self.puts_since_check += 1
+            evict = self.puts_since_check >= self.evict_check_interval
+            if evict:
+                self.puts_since_check = 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Removes the oldest results beyond max_entries."""
+        overflow = SearchResult.objects.count() - self.max_entries
+        if overflow <= 0:
+            return
+        oldest = SearchResult.objects.raw({}) \
+            .order_by([("created", pymongo.ASCENDING)]) \
+            .only("key") \
+            .limit(overflow)
+        ids = [result.key for result in oldest]
+        SearchResult.objects.raw({"_id": {"$in": ids}}).delete()
+
+    def flush(self):
+        """Nothing to do, since results are written as they are put."""
+
+
+class FileSearchCacheBackend:
+    """Stores cached search results in a local JSON file.
+
+    Used when the Mongo server can't be reached. Results are kept in memory in
+    least recently used order, and written out to the file on flush(). The
+    results are only touched with lock held, so the backend is thread-safe.
+    """
+
+    def __init__(self, path, max_entries):
+        """Instantiates the file backend, loading the file if it exists.
+
+        Args:
+            path (str): Path of the JSON file to store results in.
+            max_entries (int): Number of results kept before evicting.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for key, entry in json.load(f):
+                    self.entries[key] = entry
+
+    def get(self, key, now):
+        """Retrieve the unexpired response cached under key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires_at"] <= now.timestamp():
+                del self.entries[key]
+                self.dirty = True
+                return None
+            self.entries.move_to_end(key)
+            return entry["response"]
+
+    def put(self, key, response, now, expires_at):
+        """Cache response under key until expires_at."""
+        with self.lock:
+            self.entries[key] = {"response": response,
+                                 "expires_at": expires_at.timestamp()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def flush(self):
+        """Writes the cached results out to the file."""
+        with self.lock:
+            if not self.dirty:
+                return
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with open(self.path, "w") as f:
+                json.dump(list(self.entries.items()), f)
+            self.dirty = False
+
+
+class SearchCache:
+    """Cache of Spotify search responses keyed on artist, title and type.
+
+    Successful searches are cached for ttl, and searches that found nothing
+    are cached for the shorter negative_ttl, since the release may simply not
+    be on Spotify yet.
+    """
+
+    def __init__(self, ttl=timedelta(days=30),
+                 negative_ttl=timedelta(hours=6), max_entries=50000,
+                 file_path="../tmp/search_cache.json", clock=None):
+        """Instantiates the cache.
+
+        The Mongo backend is used if the server can be reached, otherwise
+        the results are stored in the local file at file_path.
+
+        Args:
+            ttl (timedelta): How long to keep successful search results.
+            negative_ttl (timedelta): How long to keep empty search results.
+            max_entries (int): Number of results kept before evicting.
+            file_path (str): Path of the file backend's JSON file.
+            clock (function): Returns the current (naive UTC) time. Defaults
+                to datetime.utcnow.
+        """
+        self.clock = clock or datetime.utcnow
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # Only guards the counters, since the backends lock for themselves
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.backend = MongoSearchCacheBackend(max_entries)
+        if not self.backend.is_available():
+            print("\tMongo unavailable, caching searches in " + file_path)
+            self.backend = FileSearchCacheBackend(file_path, max_entries)
+
+    def make_key(self, artist, title, type_str) -> str:
+        """Builds the cache key of a search."""
+        return "|".join((type_str, normalize(artist), normalize(title)))
+
+    def get(self, artist, title, type_str):
+        """Retrieve a cached search response.
+
+        Args:
+            artist (str): The artist searched for.
+            title (str): The title searched for.
+            type_str (str): The type searched for.
+
+        Return:
+            json: The cached Spotify search response, or None on a miss.
+        """
+        key = self.make_key(artist, title, type_str)
+        response = self.backend.get(key, self.clock())
+        with self.lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def put(self, artist, title, type_str, response):
+        """Cache a search response.
+
+        Args:
+            artist (str): The artist searched for.
+            title (str): The title searched for.
+            type_str (str): The type searched for.
+            response (json): The Spotify search response.
+        """
+        key = self.make_key(artist, title, type_str)
+        found = response.get(type_str + "s", {}).get("items")
+        ttl = self.ttl if found else self.negative_ttl
+        now = self.clock()
+        self.backend.put(key, response, now, now + ttl)
+
+    def flush(self):
+        """Persists any results not yet written by the backend."""
+        self.backend.flush()
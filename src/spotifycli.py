@@ -8,16 +8,126 @@ file: spotifycli.py
 """
 
 import json
+import re
+import requests
+from typing import Dict, List, Optional, Tuple
 import spotipy
+from spotipy.exceptions import SpotifyException
 from spotipy.oauth2 import SpotifyOAuth
 
+from chunking import chunked
+from metrics import METRICS, record_responses
+from ratelimiter import TokenBucket
+from resolutioncache import ResolutionCache
+from searchcache import SearchCache, normalize
+
 SCOPE = "playlist-modify-public playlist-modify-private playlist-read-private"
 
+# Matches Spotify track/album links, embed links and URIs
+SPOTIFY_LINK_REGEX = re.compile(r"""
+    (?:open\.spotify\.com/(?:embed/)?(?:intl-[\w-]+/)?
+    |spotify:)
+    (?P<type>track|album)[/:]
+    (?P<id>[A-Za-z0-9]{22})
+    """, re.VERBOSE)
+
+
+def parse_spotify_link(text) -> Optional[Tuple[str, str]]:
+    """Finds the first Spotify track or album link in text.
+
+    Args:
+        text (str): Text that may contain a Spotify URL, embed URL or URI.
+
+    Return:
+        tuple: The (type, id) of the linked track or album, where type is
+            either "track" or "album". None if no link was found.
+    """
+    if not text:
+        return None
+    match = SPOTIFY_LINK_REGEX.search(text)
+    if not match:
+        return None
+    return match.group("type"), match.group("id")
+
+
+class RateLimitedSpotify(spotipy.Spotify):
+    """Spotify client that sends every request through a rate limiter.
+
+    Throttled (429) requests are not retried by spotipy's session, but by
+    this client, so that the wait is shared through the rate limiter.
+    """
+
+    def __init__(self, limiter, max_throttle_retries=5, **kwargs):
+        """Instantiates the rate limited Spotify client.
+
+        Args:
+            limiter (TokenBucket): Rate limiter shared by all requests.
+            max_throttle_retries (int): Times to retry a throttled request.
+            kwargs: Arguments to pass spotipy.Spotify's initializer.
+        """
+        kwargs.setdefault("status_forcelist", (500, 502, 503, 504))
+        super().__init__(**kwargs)
+        self.limiter = limiter
+        self.max_throttle_retries = max_throttle_retries
+
+    def _build_session(self):
+        super()._build_session()
+        # urllib3 retries any response with a Retry-After header itself,
+        # whatever the status_forcelist, so 429s would never reach
+        # _internal_call and the rate limiter
+        retry = self._session.get_adapter("https://").max_retries.new(
+            respect_retry_after_header=False)
+        # Allow enough pooled connections for all threads making requests
+        adapter = requests.adapters.HTTPAdapter(max_retries=retry,
+                                                pool_maxsize=32)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def _internal_call(self, method, url, payload, params):
+        attempt = 0
+        while True:
+            METRICS.record_wait("spotify", self.limiter.acquire())
+            try:
+                # params are consumed by spotipy, so pass a copy
+                result = super()._internal_call(method, url, payload,
+                                                dict(params))
+            except SpotifyException as e:
+                if e.http_status != 429 or \
+                        attempt >= self.max_throttle_retries:
+                    raise
+                METRICS.record_wait("spotify", self.limiter.throttled(
+                    retry_after(e.headers), attempt))
+                attempt += 1
+                continue
+
+            self.limiter.succeeded()
+            return result
+
+
+def retry_after(headers):
+    """Reads the Retry-After header of a throttled response.
+
+    Args:
+        headers (dict): The response headers.
+
+    Return:
+        float: Seconds to wait before retrying, or None if not given.
+    """
+    try:
+        return float((headers or {})["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
 
 class SpotifyCli:
-    """General class to help with interacting with Spotify API."""
+    """General class to help with interacting with Spotify API.
 
-    def __init__(self):
+    A single SpotifyCli can be shared by threads processing different
+    subreddits, in which case they share its session, token and rate limiter.
+    """
+
+    def __init__(self, requests_session=True, auth=None, search_cache=None,
+                 resolution_cache=None):
         """Instantiates Spotify API Client.
 
         Uses Authentication Code Flow for authentication.
@@ -26,13 +136,44 @@ class SpotifyCli:
             SPOTIPY_CLIENT_ID='your-spotify-client-id'
             SPOTIPY_CLIENT_SECRET='your-spotify-client-secret'
             SPOTIPY_REDIRECT_URI='your-spotipy-redirect-uri'
-        """
-        auth_manager = SpotifyOAuth(scope=SCOPE)
-        self.spot = spotipy.Spotify(auth_manager=auth_manager)
-        # (Spotify sets limit max to 50)
-        self.album_tracks_limit = 50
 
-    def search(self, artist, title, type_str) -> json:
+        Args:
+            requests_session (requests.Session): Session to send requests
+                with. A new one is created if not given.
+            auth (str): A fixed access token to use instead of the
+                Authentication Code Flow.
+            search_cache (SearchCache): Cache of search results to use. A new
+                one is created if not given.
+            resolution_cache (ResolutionCache): Cache of lookups to share
+                between subreddits. A new one is created if not given.
+        """
+        auth_manager = None if auth else \
+            SpotifyOAuth(scope=SCOPE, requests_session=requests_session)
+        # Spotify doesn't publish its quota, so keep well under the usual
+        # rate of a few requests per second
+        self.limiter = TokenBucket(rate=5, capacity=10)
+        self.spot = RateLimitedSpotify(self.limiter,
+                                       auth=auth,
+                                       auth_manager=auth_manager,
+                                       requests_session=requests_session)
+        # Record what each request costs (see metrics.py), including the
+        # token requests of the auth manager
+        for session in (self.spot._session,
+                        getattr(auth_manager, "_session", None)):
+            if session is not None:
+                record_responses(session)
+        # Max ids per request to the several tracks/albums endpoints
+        self.tracks_limit = 50
+        self.albums_limit = 20
+        # Max items per page of a playlist's items
+        self.playlist_items_limit = 100
+        # Cache of search responses, shared by every search made
+        self.search_cache = search_cache or SearchCache()
+        # Lookups shared by every subreddit using this client, so that a
+        # release posted to several subreddits is looked up once
+        self.resolution_cache = resolution_cache or ResolutionCache()
+
+    def search(self, artist, title, type_str, tally=None) -> json:
         """Search an artist + title combo in Spotify.
 
         Args:
@@ -40,14 +181,35 @@ class SpotifyCli:
             artist (str): The artist.
             title (str): The song / single / album / EP.
             type_str (str): query param to pass to search's type argument.
+            tally (collections.Counter): If given, counts where the response
+                came from: "resolution_cache" (including lookups that waited
+                on another thread's search), "search_cache" or "spotify".
 
         Return:
             json: Spotify search response JSON object on success.
         """
-        query_str = title + " artist:" + artist
+        source = "resolution_cache"
+
+        def resolve():
+            nonlocal source
+            result = self.search_cache.get(artist, title, type_str)
+            if result is not None:
+                source = "search_cache"
+                return result
+
+            query_str = title + " artist:" + artist
+
+            result = self.spot.search(q=query_str, type=type_str, limit=1)
+            self.search_cache.put(artist, title, type_str, result)
+            source = "spotify"
 
-        result = self.spot.search(q=query_str, type=type_str, limit=1)
+            return result
 
+        result = self.resolution_cache.get(
+            ("search", type_str, normalize(artist), normalize(title)),
+            resolve)
+        if tally is not None:
+            tally[source] += 1
         return result
 
     def populate_from_track(self, item) -> dict:
@@ -73,7 +235,7 @@ class SpotifyCli:
 
         return populated
 
-    def populate_from_album(self, item) -> dict:
+    def populate_from_album(self, item, first_track=None) -> dict:
         """Populates the info that we care about from an album item to a dict.
 
         item is a spotify search result item that returned type "album".
@@ -81,6 +243,8 @@ class SpotifyCli:
         Args:
             spot (spotify.Spotify): Initialized Spotify client.
             item (json): Spotify album search response JSON object.
+            first_track (json): The album's first track, if already known.
+                Otherwise it is retrieved from Spotify.
 
         Return:
             dict: The populated dict with the fields that are of interest.
@@ -99,53 +263,153 @@ class SpotifyCli:
         populated["track_num"] = 1
 
         # Retreive the first track on the album
-        tracks = self.spot.album_tracks(item["uri"], 1)
+        if first_track is None:
+            first_track = self.resolution_cache.get(
+                ("first_track", item["uri"]),
+                lambda: self.spot.album_tracks(item["uri"], 1)["items"][0])
 
-        populated["track"] = tracks["items"][0]["name"]
-        populated["spotify_track_uri"] = tracks["items"][0]["uri"]
+        populated["track"] = first_track["name"]
+        populated["spotify_track_uri"] = first_track["uri"]
 
         return populated
 
-    def get_most_popular(self, spotify_album_uri) -> json:
-        """Retrieve the most popular track on album.
+    def resolve_links(self, links) -> Dict[Tuple[str, str], dict]:
+        """Populates the info of linked tracks and albums without searching.
 
-        The popularity is determined by Spotify's algorithm.
+        The tracks and albums are retrieved in batches from the several
+        tracks/albums endpoints, 50 tracks or 20 albums per request.
 
         Args:
-            spotify_album_uri (str): The Spotify album's URI.
+            links (Iterable[tuple]): (type, id) tuples as returned by
+                parse_spotify_link().
 
         Return:
-            json: The most popular track's info
+            dict: Maps each resolvable (type, id) to its populated dict, as
+                returned by populate_from_track() or populate_from_album().
         """
-        # Get all tracks in album
-        tracks = self.spot.album_tracks(spotify_album_uri,
-                                        limit=self.album_tracks_limit)["items"]
+        def resolve(keys):
+            track_ids = sorted(i for _, t, i in keys if t == "track")
+            album_ids = sorted(i for _, t, i in keys if t == "album")
+
+            resolved = dict()
+            for chunk in chunked(track_ids, self.tracks_limit):
+                for track in self.spot.tracks(chunk)["tracks"]:
+                    # Unknown ids come back as None
+                    if track:
+                        resolved[("link", "track", track["id"])] = \
+                            self.populate_from_track(track)
+
+            for chunk in chunked(album_ids, self.albums_limit):
+                for album in self.spot.albums(chunk)["albums"]:
+                    if album and album["tracks"]["items"]:
+                        resolved[("link", "album", album["id"])] = \
+                            self.populate_from_album(
+                                album, album["tracks"]["items"][0])
+
+            return resolved
+
+        resolved = self.resolution_cache.get_many(
+            [("link",) + tuple(link) for link in links], resolve)
+        return {key[1:]: populated for key, populated in resolved.items()}
+
+    def get_most_popular_many(self, spotify_album_uris) -> Dict[str, dict]:
+        """Retrieve the most popular track on each of many albums.
+
+        Albums looked up recently, or being looked up, for another subreddit
+        are taken from the resolution cache. The rest are looked up at once
+        by lookup_most_popular().
+
+        Args:
+            spotify_album_uris (Iterable[str]): The Spotify albums' URIs.
+
+        Return:
+            dict: Maps each album URI to its most popular track's info. Albums
+                that couldn't be found are left out.
+        """
+        most_popular = self.resolution_cache.get_many(
+            [("most_popular", uri) for uri in spotify_album_uris],
+            lambda keys: {("most_popular", uri): track for uri, track
+                          in self.lookup_most_popular(
+                              [uri for _, uri in keys]).items()})
+        return {key[1]: track for key, track in most_popular.items()}
+
+    def lookup_most_popular(self, spotify_album_uris) -> Dict[str, dict]:
+        """Looks up the most popular track on each album in Spotify.
+
+        The albums are retrieved 20 at a time, following the pagination of
+        albums with more than 50 tracks. The full track objects, which hold
+        the popularity, are then retrieved 50 at a time.
+
+        Args:
+            spotify_album_uris (Iterable[str]): The Spotify albums' URIs.
+
+        Return:
+            dict: Maps each album URI to its most popular track's info.
+        """
+        album_uris = sorted(set(spotify_album_uris))
+
+        # Get the uris of all tracks in each album
+        album_track_uris = dict()
+        for chunk in chunked(album_uris, self.albums_limit):
+            for album in self.spot.albums(chunk)["albums"]:
+                if not album:
+                    continue
+                paging = album["tracks"]
+                track_uris = [t["uri"] for t in paging["items"]]
+                while paging["next"]:
+                    paging = self.spot.next(paging)
+                    track_uris.extend(t["uri"] for t in paging["items"])
+                album_track_uris[album["uri"]] = track_uris
 
         # Get full track info for each, not just simplified
-        track_ids = [t.get("uri", "") for t in tracks]
-        tracks_full = self.spot.tracks(track_ids).get("tracks")
-        if not tracks_full:
-            return {}
+        all_track_uris = [uri for track_uris in album_track_uris.values()
+                          for uri in track_uris]
+        tracks_full = dict()
+        for chunk in chunked(all_track_uris, self.tracks_limit):
+            for track in self.spot.tracks(chunk)["tracks"]:
+                if track:
+                    tracks_full[track["uri"]] = track
 
         # Find most popular
-        most_popular = max(tracks_full, key=lambda x: x["popularity"])
+        most_popular = dict()
+        for album_uri, track_uris in album_track_uris.items():
+            tracks = [tracks_full[uri] for uri in track_uris
+                      if uri in tracks_full]
+            if tracks:
+                most_popular[album_uri] = max(
+                    tracks, key=lambda x: x["popularity"])
 
         return most_popular
 
-    def replace_track_at_pos(self, playlist_id, old_track_uri, new_track_uri,
-                             pos):
-        """Replaces track in playlist at pos with track_to_insert.
+    def get_playlist_snapshot_id(self, playlist_id) -> str:
+        """Gets the current version of a playlist, in a single request.
 
         Args:
             playlist_id (str): Spotify playlist ID.
-            old_track_uri (str): Spotify track URI of old track to remove.
-            new_track_uri (str): Spotify track URI of new track to insert.
-            pos (int): Position of playlist to replace track at.
+
+        Return:
+            str: The playlist's snapshot_id.
         """
-        # Remove track at pos
-        self.spot.playlist_remove_specific_occurrences_of_items(
-            playlist_id,
-            [{"uri": old_track_uri, "positions": [pos]}])
+        return self.spot.playlist(playlist_id,
+                                  fields="snapshot_id")["snapshot_id"]
+
+    def get_playlist_track_uris(self, playlist_id) -> List[str]:
+        """Gets the URIs of all tracks in a playlist, in order.
 
-        # Insert new track at same pos
-        self.spot.playlist_add_items(playlist_id, [new_track_uri], pos)
+        Args:
+            playlist_id (str): Spotify playlist ID.
+
+        Return:
+            list: The track URIs, one per playlist position. None for items
+                without a track (eg. tracks taken off Spotify), so that the
+                indices still match the playlist's positions.
+        """
+        uris = []
+        results = self.spot.playlist_items(
+            playlist_id, fields="items(track(uri)),next",
+            limit=self.playlist_items_limit)
+        while results:
+            uris.extend(item["track"]["uri"] if item["track"] else None
+                        for item in results["items"])
+            results = self.spot.next(results) if results["next"] else None
+        return uris
@@ -0,0 +1,62 @@
+"""A module for keeping track of the pipeline stage being run.
+
+Each stage of FreshTracks.run() is run inside stage(), which times it and
+records which (subreddit, stage) the current thread is working on, so that
+anything making requests along the way can attribute them to the stage.
+
+author: Soobeen Park
+file: stages.py
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import time
+
+# The (subreddit name, stage name) being run by the current thread, if any
+current_stage = ContextVar("current_stage", default=None)
+
+
+@contextmanager
+def stage(subreddit_name, stage_name, stage_times):
+    """Runs the body as a stage of a subreddit's run.
+
+    Args:
+        subreddit_name (str): The subreddit being run.
+        stage_name (str): The name of the stage.
+        stage_times (dict): Dict to add the stage's wall time (in seconds) to,
+            keyed by stage name.
+    """
+    token = current_stage.set((subreddit_name, stage_name))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_times[stage_name] = stage_times.get(stage_name, 0.0) + \
+            time.perf_counter() - start
+        current_stage.reset(token)
+
+
+def in_current_stage(fn):
+    """Wraps fn to run in the calling thread's stage, from any thread.
+
+    Threads in a pool don't inherit the stage of the thread that submitted
+    work to them, so work submitted to a pool should be wrapped with this.
+
+    Args:
+        fn (function): The function to wrap.
+
+    Return:
+        function: The wrapped function.
+    """
+    stage_key = current_stage.get()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = current_stage.set(stage_key)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            current_stage.reset(token)
+
+    return wrapper
@@ -0,0 +1,260 @@
+"""A module for parsing [FRESH] Reddit posts.
+
+Contains the regexes, compiled once at import, and the per-subreddit rules
+used to parse artist and title out of a post's title, flair or embedded
+Spotify media description.
+
+author: Soobeen Park
+file: titleparser.py
+"""
+
+import re
+from typing import List
+
+# Spotify embedded media description, ie.
+# "Listen to Title on Spotify. Artist · Album · 2020 · 12 songs."
+DESC_REGEX = re.compile(r"""^Listen\ to\s
+        (?P<title>.+)\s                 # Title
+        on\ Spotify.\s
+        (?P<artist>.+)\s                # Artist
+        (·)?\s
+        (?P<type>\w+)\s                 # Type
+        (·)?\s
+        (?P<year>\d+)                   # Year
+        (\s·\s(?P<num_songs>\d+)\ssongs)?    # Num songs (if exist)
+        .$""", re.VERBOSE)
+
+# The title regexes below are divided into 2 different artist-title groups to
+# account for any dashes/hyphens in the artist or title names
+TITLE_REGEX = re.compile(r"""
+    ((?P<artist1>.+)\s?                         # Artist1
+    -\s?
+    (?P<title1>.+)                              # Title1
+    |
+    (?P<artist2>.+)                             # Artist2
+    -
+    (?P<title2>.+))                             # Title 2
+    """, re.VERBOSE | re.IGNORECASE)
+
+FRESH_TITLE_REGEX = re.compile(r"""
+    \[\s*(?P<freshtype>fresh\s*\w*)\s*\]\s*     # FRESH type
+    ((?P<artist1>.+)\s?                         # Artist1
+    -\s?
+    (?P<title1>.+)                              # Title1
+    |
+    (?P<artist2>.+)                             # Artist2
+    -
+    (?P<title2>.+))                             # Title 2
+    """, re.VERBOSE | re.IGNORECASE)
+
+# Parenthesized parts of artist/title, ie. "(feat. Artist)"
+PAREN_REGEX = re.compile(r"\(.*\)")
+
+# Qualifiers of the valid freshtypes. See is_valid_freshtype()
+VALID_QUALIFIER_REGEX = re.compile(r"album|ep|single|stream")
+
+
+def is_valid_freshtype(freshtype) -> bool:
+    """Checks if the tag used in [FRESH ___] is a "valid" type.
+
+    We are only interested in processing valid freshtypes, ie. [FRESH],
+    [FRESH ALBUM], [FRESH EP], [FRESH SINGLE] and [FRESH STREAM].
+
+    Args:
+        freshtype (str): The freshtype tagged in the reddit post.
+
+    Returns:
+        bool: True if valid freshtype, false if otherwise.
+    """
+    freshtype_lower = freshtype.lower()
+    return freshtype_lower == "fresh" or \
+        VALID_QUALIFIER_REGEX.search(freshtype_lower) is not None
+
+
+def parse_embedded_media(media_description_str) -> dict:
+    """Parses the embedded Spotify media description in the reddit post.
+
+    Args:
+        media_description_str (str): Post's Spotify media description str
+
+    Return:
+        dict: A dictionary containing parsed information from the arg.
+    """
+    match = DESC_REGEX.search(media_description_str)
+
+    if not match:
+        # Return empty dict for fail to parse
+        return dict()
+
+    # Regex properly parsed
+    gd = match.groupdict()
+    if gd.get("num_songs", None) is None:
+        gd["num_songs"] = 1
+
+    return gd
+
+
+def artist_title_from_match(gd, freshtype) -> dict:
+    """Builds the parsed dict from a TITLE_REGEX or FRESH_TITLE_REGEX match.
+
+    Args:
+        gd (dict): The groupdict of the match.
+        freshtype (str): The freshtype of the post.
+
+    Return:
+        dict: The parsed artist, title and freshtype, or an empty dict if
+            the parsed artist or title is empty.
+    """
+    if gd["artist1"]:     # Regex matched artist1-title1 groups
+        artist, title = gd["artist1"], gd["title1"]
+    else:           # Regex matched artist2-title2 groups
+        artist, title = gd["artist2"], gd["title2"]
+
+    artist = PAREN_REGEX.sub("", artist).strip()
+    title = PAREN_REGEX.sub("", title).strip()
+
+    # Exit early if parsed artist or title is empty
+    if not artist or not title:
+        return dict()
+
+    return {"artist": artist, "title": title, "freshtype": freshtype}
+
+
+def parse_title_wo_fresh(freshtype, title_str) -> dict:
+    """Parses the post title, that does not contain [FRESH (___)] in title.
+
+    Args:
+        freshtype (str): The freshtype tagged in the reddit post.
+        title_str (str): The post's title string.
+
+    Return:
+        dict: A dictionary containing parsed information from the arg.
+            If parsing failed or invalid freshtype, empty dict is returned.
+    """
+    # Exit early if not a valid freshtype in title
+    if not freshtype or not is_valid_freshtype(freshtype):
+        return dict()
+
+    match = TITLE_REGEX.search(title_str)
+    if not match:
+        return dict()
+
+    return artist_title_from_match(match.groupdict(), freshtype)
+
+
+def parse_title_with_fresh(title_str) -> dict:
+    """Parses the post title with FRESH in the title.
+
+    We assume that the post title must be of '[FRESH (___)] Artist - Title'.
+    Otherwise, an empty dict is returned.
+
+    Args:
+        title_str (str): The post's title string.
+
+    Return:
+        dict: A dictionary containing parsed information from the arg.
+            If parsing failed or invalid freshtype, empty dict is returned.
+    """
+    match = FRESH_TITLE_REGEX.search(title_str)
+    if not match:
+        return dict()
+
+    gd = match.groupdict()
+
+    # Exit early if not a valid freshtype in title
+    if not is_valid_freshtype(gd["freshtype"]):
+        return dict()
+
+    return artist_title_from_match(gd, gd["freshtype"])
+
+
+# Parse rules, by name. Each takes a post's title, flair text and embedded
+# Spotify media description (the latter two may be None).
+RULES = {
+    "embedded_media":
+        lambda title, flair, desc: parse_embedded_media(desc) if desc
+        else dict(),
+    "title_with_fresh":
+        lambda title, flair, desc: parse_title_with_fresh(title),
+    "flair_title":
+        lambda title, flair, desc: parse_title_wo_fresh(flair, title),
+}
+
+# The rules used for each subreddit, tried in order until one parses the post.
+# A post's embedded media is always the most reliable, so it is tried first.
+SUBREDDIT_RULES = {
+    "indieheads": ["embedded_media", "title_with_fresh"],
+    "hiphopheads": ["embedded_media", "title_with_fresh"],
+    # popheads tags posts with [FRESH] in the flair instead of the title
+    "popheads": ["embedded_media", "flair_title"],
+}
+
+# The rules used for subreddits without rules of their own
+DEFAULT_RULES = ["embedded_media", "title_with_fresh", "flair_title"]
+
+
+def register_subreddit(subreddit_name, rule_names):
+    """Registers the parse rules used for a subreddit.
+
+    Args:
+        subreddit_name (str): The name of the subreddit.
+        rule_names (list): Names of rules in RULES, in the order to try them.
+    """
+    for rule_name in rule_names:
+        if rule_name not in RULES:
+            raise ValueError("Unknown parse rule " + rule_name)
+    SUBREDDIT_RULES[subreddit_name] = list(rule_names)
+
+
+class TitleParser:
+    """Parses the posts of a subreddit, according to its parse rules."""
+
+    def __init__(self, subreddit_name):
+        """Instantiates TitleParser.
+
+        Args:
+            subreddit_name (str): The name of the subreddit being parsed.
+        """
+        rule_names = SUBREDDIT_RULES.get(subreddit_name, DEFAULT_RULES)
+        self.rules = [RULES[rule_name] for rule_name in rule_names]
+
+    def parse(self, title, flair=None, desc=None) -> dict:
+        """Parses a single post.
+
+        Args:
+            title (str): The post's title.
+            flair (str): The post's flair text, if any.
+            desc (str): The post's embedded Spotify media description, if any.
+
+        Return:
+            dict: The parsed information, or an empty dict if no rule could
+                parse the post.
+        """
+        for rule in self.rules:
+            parsed = rule(title, flair, desc)
+            if parsed:
+                return parsed
+        return dict()
+
+    def parse_many(self, entries) -> List[dict]:
+        """Parses many posts in a single pass.
+
+        Args:
+            entries (Iterable[tuple]): (title, flair, desc) tuples, one per
+                post, as passed to parse().
+
+        Return:
+            list: The parsed dict of each post, in the same order. Posts that
+                couldn't be parsed get an empty dict.
+        """
+        rules = self.rules
+        parsed_posts = []
+        append = parsed_posts.append
+        for title, flair, desc in entries:
+            parsed = dict()
+            for rule in rules:
+                parsed = rule(title, flair, desc)
+                if parsed:
+                    break
+            append(parsed)
+        return parsed_posts
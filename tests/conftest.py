@@ -0,0 +1,10 @@
+"""Makes the modules in src importable by the tests, as main.py imports them.
+
+author: Soobeen Park
+file: conftest.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
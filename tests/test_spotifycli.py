@@ -0,0 +1,79 @@
+"""Tests for spotifycli.py's handling of throttled (429) responses.
+
+author: Soobeen Park
+file: test_spotifycli.py
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+import pytest
+import spotipy
+
+from ratelimiter import TokenBucket
+from spotifycli import RateLimitedSpotify
+
+
+@pytest.fixture
+def server():
+    """Local server answering 429 to the first requests, then 200.
+
+    Set server.throttle to the number of requests to throttle.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.requests += 1
+            if self.server.requests <= self.server.throttle:
+                self.send_response(429)
+                self.send_header("Retry-After", "0")
+                body = json.dumps({"error": {"status": 429,
+                                             "message": "API rate limit"}})
+            else:
+                self.send_response(200)
+                body = json.dumps({"ok": True})
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.requests = 0
+    httpd.throttle = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def spotify(server, limiter, **kwargs):
+    """A RateLimitedSpotify with its own session, sending to server."""
+    spot = RateLimitedSpotify(limiter, auth="token", **kwargs)
+    spot.prefix = "http://127.0.0.1:%d/" % server.server_address[1]
+    return spot
+
+
+def test_throttled_request_reaches_limiter(server):
+    server.throttle = 2
+    limiter = TokenBucket(rate=100, capacity=10)
+
+    assert spotify(server, limiter)._get("me") == {"ok": True}
+    assert server.requests == 3
+    assert limiter.stats()["throttled"] == 2
+
+
+def test_throttled_request_gives_up_after_max_retries(server):
+    server.throttle = 10
+    limiter = TokenBucket(rate=100, capacity=10)
+    spot = spotify(server, limiter, max_throttle_retries=1)
+
+    with pytest.raises(spotipy.SpotifyException) as e:
+        spot._get("me")
+    assert e.value.http_status == 429
+    assert server.requests == 2
+    assert limiter.stats()["throttled"] == 1